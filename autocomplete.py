@@ -1,17 +1,10 @@
+import heapq
+from itertools import chain
+from operator import itemgetter
 from discord import Interaction
 from discord.app_commands import Choice
 from datetime import datetime
-
-
-def strip_names(*args):
-    final = []
-    for arg in args:
-        if arg is not None:
-            arg = str(arg)
-            final.append(''.join([letter.lower() for letter in arg if letter.isalnum()]))
-        else:
-            final.append(None)
-    return final
+from search_index import SearchIndex, tokenize
 
 
 # autocomplete names fail if a choice is over 100 characters, so this will modify names to take that into account
@@ -27,42 +20,25 @@ def autocomplete_slice_names_100(name):
     return cut_title
 
 
-# some of these functions wont work properly if there aren't exact matches which is bad, so this is a search function
-# it goes through each word in a string and tries to find if there are matching words in the current string
-def autocomplete_search_list(current_str: str, strs_to_search: tuple):
-    translate_table = str.maketrans('', '', '\'",-.!/():')
-    current_words = current_str.translate(translate_table).split(' ')
-    return_list = list()
-    for item in strs_to_search:
-        tuple_to_search = tuple(item[0].translate(translate_table).split(' '))
-        if all([any([string1.lower() in string2.lower() for string2 in tuple_to_search]) for string1 in current_words]):
-            return_list.append(item)
-    return return_list
-
-
-def filter_year(all_ratings, year):
-    # filters albums by year (or does not filter if year filtering is turned off)
-    return [row for row in all_ratings if year == -1 or year == row['year']]
-
-
-def get_max_albums_possible(get_all_ratings,  year=datetime.now().year, minratings: int = None):
-    ratings_year = filter_year(get_all_ratings(), year)
+# get_rating_counts gives the number of ratings of each album in a year, most ratings first
+async def get_max_albums_possible(get_rating_counts, year=datetime.now().year, minratings: int = None):
+    rating_counts = await get_rating_counts(year)
     if minratings is None:
-        return len(ratings_year)
-    # filters albums - if the number of ratings is greater than the min_ratings
-    final_dict = {row for row in ratings_year if len(row['ratings']) >= minratings}
-    return len(final_dict)
+        return len(rating_counts)
+    # counts albums - if the number of ratings is greater than the min_ratings
+    return len([count for count in rating_counts if count >= minratings])
 
 
-def get_min_ratings_possible(get_all_ratings, year=datetime.now().year, numalbums: int = None):
-    ratings_year = filter_year(get_all_ratings(), year)
+async def get_min_ratings_possible(get_rating_counts, year=datetime.now().year, numalbums: int = None):
+    rating_counts = await get_rating_counts(year)
+    if len(rating_counts) == 0:
+        return 0
 
-    # sort the dictionary by number of ratings,
-    # then go down however many rows and return the number of ratings on that album
-    final_dict = list(sorted(ratings_year, key=lambda row: len(row['ratings']), reverse=True))
+    # counts are already sorted by number of ratings,
+    # so go down however many rows and return the number of ratings on that album
     if numalbums is None:
-        return len(final_dict[-1])
-    return len(final_dict[numalbums - 1])
+        return rating_counts[0]
+    return rating_counts[min(max(numalbums, 1), len(rating_counts)) - 1]
 
 
 # this takes in a list of (artist, album, value) and returns that list with all entries as less than 100 characters
@@ -70,23 +46,124 @@ def autocomplete_slice_list_names(choices):
     return [tuple(autocomplete_slice_names_100(name) if len(name) > 100 else name for name in choice) for choice in choices]
 
 
+# RANKED SEARCH SECTION-------------------------------------------------------------------------------------------------
+# ranks the entries of a search_index.SearchIndex against what's been typed so far, best first.
+# every query word gets a score against every word of an entry, and the entry's score is the sum of the best ones:
+# typing a whole word beats the start of a word, which beats somewhere in the middle of a word,
+# which beats a word that's only similar (a typo). a query word that doesn't match anything at all rules the entry out.
+# entries starting with the first query word get a bonus, and shorter entries win ties.
+# only entries with a word matching the query get looked at, and heapq picks the top ones without sorting them all
+EXACT_SCORE = 3.0
+WORD_START_SCORE = 2.0
+SUBSTRING_SCORE = 1.0
+TYPO_SCORE = 1.0
+ENTRY_START_BONUS = 0.5
+# the most matching entries we'll rank (and the most entries we'll look at) for one keystroke.
+# the best matching words get looked at first, so the entries that get cut off only had worse matches anyway
+MAX_CANDIDATES = 500
+MAX_EXAMINED = 2000
+
+
+def score_word(part: str, word: str) -> float:
+    if word == part:
+        return EXACT_SCORE
+    # the closer the query word is to the length of the whole word, the better
+    closeness = len(part) / len(word)
+    if word.startswith(part):
+        return WORD_START_SCORE + closeness
+    return SUBSTRING_SCORE + closeness
+
+
+# the words in the index that could match one query word, and how well
+class PartMatcher:
+    def __init__(self, index: SearchIndex, part: str, limit: int):
+        self.index = index
+        self.part = part
+        self.containing = index.words_containing(part)
+        # only bother looking for typos if the word isn't in enough other words
+        self.typos = index.similar_words(part) if len(self.containing) < limit else {}
+        # entries share a lot of words, so each word only gets scored once
+        self.scores = {}
+
+    def __len__(self):
+        return len(self.containing) + len(self.typos)
+
+    def score(self, word: str) -> float:
+        score = self.scores.get(word)
+        if score is None:
+            if word in self.containing:
+                score = score_word(self.part, word)
+            else:
+                score = TYPO_SCORE * self.typos.get(word, 0.0)
+            self.scores[word] = score
+        return score
+
+    # matching words from best to worst: the word itself, words starting with it, words containing it, then typos
+    def best_words(self):
+        if self.part in self.containing:
+            yield self.part
+        for word in self.index.words_starting_with(self.part):
+            if word != self.part:
+                yield word
+        for word in self.containing:
+            if not word.startswith(self.part):
+                yield word
+        yield from sorted(self.typos, key=self.typos.get, reverse=True)
+
+
+# keys of the (up to) limit best entries for query
+def ranked_search(index: SearchIndex, query: str, limit: int = 25) -> list:
+    parts = tokenize(query)
+    if not parts:
+        return index.search(query, limit)
+    matchers = [PartMatcher(index, part, limit) for part in parts]
+    if not all(matchers):
+        return []
+
+    def score_entry(key):
+        words = index.words_by_key[key]
+        total = 0.0
+        for matcher in matchers:
+            best = max(map(matcher.score, words))
+            if best == 0.0:
+                return None
+            total += best
+        text = index.texts[key]
+        if text.lower().startswith(parts[0]):
+            total += ENTRY_START_BONUS
+        return total - len(text) / 10000
+
+    # the candidates come from whichever query word matches the fewest words, best matching words first
+    scored = []
+    seen = set()
+    for key in chain.from_iterable(index.keys_by_word[word] for word in min(matchers, key=len).best_words()):
+        if key in seen:
+            continue
+        seen.add(key)
+        score = score_entry(key)
+        if score is not None:
+            scored.append((score, key))
+        if len(scored) >= MAX_CANDIDATES or len(seen) >= MAX_EXAMINED:
+            break
+    return [key for score, key in heapq.nlargest(limit, scored, key=itemgetter(0))]
+
+
 # gets a list of artists in album_master and returns a list of choices for use in autocomplete
-def autocomplete_artist(get_album_master):
+# artist_index is master_table.artist_index, so this never has to read the table
+def autocomplete_artist(artist_index: SearchIndex):
     async def inner(interaction: Interaction, current: str) -> list[Choice[str]]:
-        final_list = {", ".join(row['artist']) for row in get_album_master()}
-        return [Choice(name=artist, value=artist)
-                for artist in final_list if strip_names(current)[0] in strip_names(artist)[0]][:25]
+        final_list = autocomplete_slice_list_names([(artist,) for artist in ranked_search(artist_index, current)])
+        return [Choice(name=artist[0], value=artist[0]) for artist in final_list][:25]
     return inner
 
 
 # same as above, but it does albums with autocomplete
-# get_album_master is a refernece to the function in main
-def autocomplete_album(get_album_master):
+# album_index is master_table.album_index, and get_album_name turns an album_id from it into the album's name
+def autocomplete_album(album_index: SearchIndex, get_album_name):
     async def inner(interaction: Interaction, current: str) -> list[Choice[str]]:
-        albums = tuple((row['album_name']) for row in get_album_master())
-        final_list = autocomplete_slice_list_names(albums)
-        return [Choice(name=album[0], value=album[0])
-                for album in final_list if strip_names(current)[0] in strip_names(album[0])[0]][:25]
+        albums = list(dict.fromkeys(get_album_name(album_id) for album_id in ranked_search(album_index, current)))
+        final_list = autocomplete_slice_list_names([(album,) for album in albums])
+        return [Choice(name=album[0], value=album[0]) for album in final_list][:25]
     return inner
 
 
@@ -101,11 +178,11 @@ def autocomplete_spotify(search_album):
 
 
 # gets a formatted list of choices of artist - album using album_master
-def autocomplete_artist_album(get_album_master):
+# album_index is master_table.album_index, which maps album_id -> "artist - album"
+def autocomplete_artist_album(album_index: SearchIndex):
     async def inner(interaction: Interaction, current: str) -> list[Choice[str]]:
-        user_albums = tuple([(", ".join(row['artist']) + f" - {row['album_name']}", f"{row['album_id']}") for row in get_album_master()])
-        filtered_list = autocomplete_search_list(current, user_albums)
-        final_list = autocomplete_slice_list_names(filtered_list)
+        albums = [(album_index.texts[album_id], album_id) for album_id in ranked_search(album_index, current)]
+        final_list = autocomplete_slice_list_names(albums)
         return [Choice(name=entry[0], value=entry[1]) for entry in final_list][:25]
     return inner
 
@@ -114,7 +191,7 @@ def autocomplete_artist_album(get_album_master):
 def autocomplete_artist_album_user_specific(get_rows_from_user):
     async def inner(interaction: Interaction, current: str) -> list[Choice[str]]:
         albums = [(", ".join(row['artist']) + f" - {row['album_name']}", f"{row['album_id']}")
-                  for row in get_rows_from_user(interaction.user.id)]
+                  for row in await get_rows_from_user(interaction.user.id)]
         final_list = autocomplete_slice_list_names(albums)
 
         return [Choice(name=entry[0], value=entry[1])
@@ -123,10 +200,10 @@ def autocomplete_artist_album_user_specific(get_rows_from_user):
 
 
 # gets formatted choices for artist/album when editing/deleting rows from homework
-def autocomplete_artist_album_homework_specific(get_homework, conn):
+def autocomplete_artist_album_homework_specific(get_homework):
     async def inner(interaction: Interaction, current: str) -> list[Choice[str]]:
         homework_list = [(", ".join(row['artist']) + f" - {row['album_name']}", f"{row['album_id']}")
-                         for row in get_homework(user_id=interaction.user.id)]
+                         for row in await get_homework(user_id=interaction.user.id)]
         final_list = autocomplete_slice_list_names(homework_list)
         return [Choice(name=entry[0], value=entry[1])
                 for entry in final_list if current.lower() in entry[0].lower()][:25]
@@ -134,22 +211,22 @@ def autocomplete_artist_album_homework_specific(get_homework, conn):
 
 
 # gets choices for num albums as part of top_albums command
-def autocomplete_top_albums_numalbums(get_all_ratings):
+def autocomplete_top_albums_numalbums(get_rating_counts):
     async def inner(interaction: Interaction, current: str) -> list[Choice[int]]:
         min_ratings = interaction.namespace.minimumratings
         year = interaction.namespace.year if interaction.namespace.year is not None else datetime.now().year
-        max_num_albums = get_max_albums_possible(get_all_ratings, year=year, minratings=min_ratings)
+        max_num_albums = await get_max_albums_possible(get_rating_counts, year=year, minratings=min_ratings)
         return [Choice(name=str(num), value=num)
                 for num in range(1, max_num_albums+1) if str(current) in str(num)]
     return inner
 
 
 # gets choices for num albums as part of top_albums command
-def autocomplete_top_albums_minratings(get_all_ratings):
+def autocomplete_top_albums_minratings(get_rating_counts):
     async def inner(interaction: Interaction, current: str) -> list[Choice[int]]:
         numalbums = interaction.namespace.numberofalbums
         year = interaction.namespace.year if interaction.namespace.year is not None else datetime.now().year
-        max_min_num_ratings = get_min_ratings_possible(get_all_ratings, year=year, numalbums=numalbums)
+        max_min_num_ratings = await get_min_ratings_possible(get_rating_counts, year=year, numalbums=numalbums)
         return [Choice(name=str(num), value=num)
                 for num in range(1, max_min_num_ratings+1) if str(current) in str(num)]
     return inner
@@ -0,0 +1,99 @@
+import sqlite3
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from json import dumps, loads
+from threading import Lock
+from time import monotonic, time
+
+# small caching helpers so we don't have to keep asking spotify (or the database) for the same things over and over
+# LRUCache lives in memory and forgets the least recently used entries once it fills up,
+# SQLiteCache is a slower tier that survives restarts
+
+
+_MISSING = object()
+
+
+@dataclass
+class LRUCache:
+    maxsize: int = 256
+    ttl: float | None = None
+
+    def __post_init__(self):
+        # maps key -> (expiry time, value), ordered from least to most recently used
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            expires, value = entry
+            if expires is not None and expires < monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        expires = monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._data)
+
+
+# key/value store inside a sqlite file, values are stored as JSON.
+# rows older than ttl seconds are treated as missing, and once the table gets bigger than max_rows
+# the oldest rows get thrown out. this uses its own connection so it can be used from any thread
+@dataclass
+class SQLiteCache:
+    path: str
+    name: str
+    ttl: float = 60 * 60 * 24 * 30
+    max_rows: int = 10000
+    evict_every: int = 100
+    _puts: int = field(default=0, init=False)
+
+    def __post_init__(self):
+        self._lock = Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(f'''CREATE TABLE IF NOT EXISTS {self.name}
+            (key VARCHAR(255) PRIMARY KEY, value TEXT, stored_at FLOAT)''')
+            self._conn.execute(f'''CREATE INDEX IF NOT EXISTS {self.name}_stored_at ON {self.name} (stored_at)''')
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute(f'''SELECT value FROM {self.name} WHERE key = ? AND stored_at > ?''',
+                                     (key, time() - self.ttl)).fetchone()
+        return default if row is None else loads(row[0])
+
+    def put(self, key, value):
+        with self._lock, self._conn:
+            self._conn.execute(f'''INSERT OR REPLACE INTO {self.name} (key, value, stored_at) VALUES (?, ?, ?)''',
+                               (key, dumps(value), time()))
+            self._puts += 1
+            if self._puts % self.evict_every == 0:
+                self._evict()
+
+    # drops expired rows, then drops the oldest rows until we're under max_rows
+    def _evict(self):
+        self._conn.execute(f'''DELETE FROM {self.name} WHERE stored_at <= ?''', (time() - self.ttl,))
+        self._conn.execute(f'''DELETE FROM {self.name} WHERE key IN
+        (SELECT key FROM {self.name} ORDER BY stored_at DESC LIMIT -1 OFFSET ?)''', (self.max_rows,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,23 +1,46 @@
+import asyncio
 from discord import TextChannel, User
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from traceback import print_exc
 from typing import Callable
+from messages import MESSAGE_LIMIT, pack_lines
 
 # the changelog is a channel where every single time an update is made to someones rankings/homework,
 # it will send a message so everyone can see recent changes.
 # all of this can be disabled by setting CHANGELOG_ACTIVE to False
-# in an added album, the changes parameter is the album_id, followed by the rating
+#
+# events don't talk to discord themselves, they just get put on a queue. a background task waits for the first event,
+# gives it flush_delay seconds for others to pile up, then sends everything it has in as few messages as it can
+# (one block per person per section, packed into messages under discord's 2000 character limit).
+# album names come from describe_album (master_table's index / the album cache in main), not a spotify call per event
+
+
+@dataclass
+class ChangelogEvent:
+    section: str
+    user_id: int
+    album_id: str
+    # the line shown in the changelog, {album} gets replaced with "artist - album name"
+    text: str
 
 
 @dataclass
 class Changelog:
     changelog_active: bool
-    get_album: Callable
+    # async function that turns an album_id into "artist - album name"
+    describe_album: Callable
     changelog_channel: int
     users: set[int]
     channel: TextChannel | None = None
+    flush_delay: float = 1.0
+    queue: asyncio.Queue = field(default_factory=asyncio.Queue)
+    task: asyncio.Task | None = None
 
     async def initialize_channel(self, client):
         self.channel = await client.fetch_channel(self.changelog_channel)
+        # on_ready can run more than once (reconnects), only ever start one flusher
+        if self.changelog_active and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self.run())
 
     @staticmethod
     def check_decorator(inner):
@@ -27,55 +50,100 @@ class Changelog:
             return None
         return wrapper
 
+    def post(self, section: str, user: User | int, album_id: str | None, text: str):
+        user_id = user if isinstance(user, int) else user.id
+        self.queue.put_nowait(ChangelogEvent(section, user_id, album_id, text))
+
+    # background task, sends whatever has been queued every time something comes in
+    async def run(self):
+        while True:
+            events = [await self.queue.get()]
+            await asyncio.sleep(self.flush_delay)
+            while not self.queue.empty():
+                events.append(self.queue.get_nowait())
+            try:
+                for message in await self.format_events(events):
+                    await self.channel.send(message)
+            except Exception:
+                print_exc()
+
+    async def format_events(self, events: list[ChangelogEvent]) -> list[str]:
+        # every album only gets looked up once, however many events mention it
+        # (an album that can't be looked up just shows its id, instead of losing the whole batch)
+        album_ids = list(dict.fromkeys(event.album_id for event in events if event.album_id is not None))
+        names = {}
+        for album_id, name in zip(album_ids, await asyncio.gather(
+                *[self.describe_album(album_id) for album_id in album_ids], return_exceptions=True)):
+            if isinstance(name, Exception):
+                print(f'error: could not look up album {album_id} for the changelog: {name!r}')
+                name = album_id
+            names[album_id] = name
+
+        # events from the same person in the same section end up under a single heading, in the order they happened
+        blocks = {}
+        for event in events:
+            line = event.text.format(album=names.get(event.album_id))
+            blocks.setdefault((event.section, event.user_id), []).append(line)
+        lines = []
+        for (section, user_id), block in blocks.items():
+            if section:
+                lines.append(f"{section} - <@{user_id}>:\n")
+            lines.extend(f"{line}\n" for line in block)
+        return pack_lines(lines)
+
     @check_decorator
-    async def event_add_ranking(self, user: User, album_id: int, rating: float):
+    def event_add_ranking(self, user: User, album_id: str, rating: float):
         if user.id not in self.users:
-            await self.event_new_user(user)
-        album = self.get_album(album_id=album_id)
-        artist = ", ".join([artist.name for artist in album.artists])
-        await self.channel.send(f"RANKINGS - {user.mention}:\n`rated {artist} - {album.name} as a {rating}`")
+            self.event_new_user(user)
+        self.post("RANKINGS", user, album_id, f"`rated {{album}} as a {rating}`")
 
     # in an edited album, the changes parameter is the album_id, the old rating, and the new rating
     @check_decorator
-    async def event_edit_ranking(self, user: User, album_id: int, old_rating: float, new_rating: float):
-        album = self.get_album(album_id=album_id)
-        artist = ", ".join([artist.name for artist in album.artists])
-        await self.channel.send(f"RANKINGS - {user.mention}:\n`changed {artist} - {album.name} from a {old_rating}/10.0 to a {new_rating}/10.0`")
+    def event_edit_ranking(self, user: User, album_id: str, old_rating: float, new_rating: float):
+        self.post("RANKINGS", user, album_id, f"`changed {{album}} from a {old_rating}/10.0 to a {new_rating}/10.0`")
 
     # in a removed album, the changes parameter is the album_id
-    # we need to use spotify api since it may not be in album_master after the removal
     @check_decorator
-    async def event_remove_ranking(self, user: User, album_id: int):
-        album = self.get_album(album_id=album_id)
-        artist = ", ".join([artist.name for artist in album.artists])
-        await self.channel.send(f"RANKINGS - {user.mention}:\n`removed {artist} - {album.name} from their rankings`")
+    def event_remove_ranking(self, user: User, album_id: str):
+        self.post("RANKINGS", user, album_id, "`removed {album} from their rankings`")
 
     # in an added homework album, the changes parameter is the album_id, then the user who initiated them
     @check_decorator
-    async def event_add_homework(self, user: User, album_id: int, user_affected: User):
-        if user not in self.users:
-            await self.event_new_user(user)
-        album = self.get_album(album_id=album_id)
-        artist = ", ".join([artist.name for artist in album.artists])
+    def event_add_homework(self, user: User, album_id: str, user_affected: User):
+        if user.id not in self.users:
+            self.event_new_user(user)
         if user.id == user_affected.id:
-            await self.channel.send(f"HOMEWORK - {user.mention}:\n`added {artist} - {album.name} to their homework list`")
+            self.post("HOMEWORK", user, album_id, "`added {album} to their homework list`")
         else:
-            await self.channel.send(f"HOMEWORK - {user.mention}:\n`added {artist} - {album.name} to {user_affected.mention}'s homework list`")
+            self.post("HOMEWORK", user, album_id, f"`added {{album}} to` {user_affected.mention}`'s homework list`")
+
+    # one album added to a bunch of peoples homework at once (add-all-homework), users_affected is a list of ids.
+    # the mentions get split over as many lines as needed so no single line goes over the message limit
+    @check_decorator
+    def event_add_homework_bulk(self, user: User, album_id: str, users_affected: list[int]):
+        if user.id not in self.users:
+            self.event_new_user(user)
+        mentions = [f"<@{user_id}>" for user_id in users_affected]
+        while mentions:
+            line = "`added {album} to the homework of`"
+            while mentions and len(line) + len(mentions[0]) + 1 < MESSAGE_LIMIT - 200:
+                line += f" {mentions.pop(0)}"
+            self.post("HOMEWORK", user, album_id, line)
 
     # in a finished homework album, the changes parameter is the album_id
-    # we have to use spotify api because it may have been removed from album_master
     @check_decorator
-    async def event_finish_homework(self, user: User, album_id: int):
-        album = self.get_album(album_id=album_id)
-        artist = ", ".join([artist.name for artist in album.artists])
-        await self.channel.send(f"HOMEWORK - {user.mention}:\n`listened to {artist} - {album.name}`")
+    def event_finish_homework(self, user: User, album_id: str):
+        self.post("HOMEWORK", user, album_id, "`listened to {album}`")
 
-    # honestly i just need to get rid of this functionality, i barely ever use it anywhere
+    # used by /import-ratings, so an import shows up as one line instead of one per album
     @check_decorator
-    async def event_add_bulk(self, user: User):
-        await self.channel.send(f"RANKINGS - {user.mention} just added a bunch of new albums to their rankings")
+    def event_add_bulk(self, user: User):
+        if user.id not in self.users:
+            self.event_new_user(user)
+        self.post("", user, None, f"RANKINGS - {user.mention} just added a bunch of new albums to their rankings")
 
     @check_decorator
-    async def event_new_user(self, user: User):
-        self.users.remove(user.id)
-        await self.channel.send(f"{user.mention} used rankingbot for the first time lfgggg")
+    def event_new_user(self, user: User):
+        self.users.add(user.id)
+        self.post("", user, None, f"{user.mention} used rankingbot for the first time lfgggg")
+
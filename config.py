@@ -13,6 +13,10 @@ class Config:
     spotify_client_id: str
     spotify_client_secret: str
     spotify_refresh_token: str
+    # seconds to wait after the last rating change before redrawing a year's rankings
+    rankings_debounce: float = 2.0
+    # whether everyone's homework gets mirrored into a spotify playlist
+    playlists_active: bool = False
 
     @classmethod
     def from_file(cls, config_file_name):
@@ -1,10 +1,15 @@
 # import useful modules
 import asyncio
+from collections import defaultdict
 from datetime import datetime
-from traceback import print_exc
-from json import dumps, loads
+from functools import partial
+from itertools import groupby
+from traceback import print_exc, print_exception
+from json import dumps
 import sqlite3
-import statistics
+from io import BytesIO
+from math import sqrt
+from typing import Literal
 
 # import discord things
 import discord
@@ -12,10 +17,17 @@ from discord import app_commands
 from discord.app_commands import Choice
 
 # import other files
-from spotify_integration import Spotify
+from spotify_integration import Spotify, release_year
 import autocomplete as ac
 from changelog import Changelog
+from messages import split_message, pack_lines
+from refresher import RankingsRefresher
+from playlists import PlaylistSyncer
+from undo import Undoer
+import ratings_io
+from cache import LRUCache
 from config import Config
+import migrations
 import tables
 
 
@@ -38,25 +50,53 @@ tree = app_commands.CommandTree(client)
 
 # configure sqlite3 settings (custom JSON datatype)
 # this allows sqlite to process dictionaries and lists (which it needs to do for when i input artists,
-# since i'm storing them in a JSON format), and allows for retrieval from JSON format into dictionaries/lists
-sqlite3.register_adapter(dict, dumps)
-sqlite3.register_adapter(list, dumps)
-sqlite3.register_converter('JSON', loads)
+# since i'm storing them in a JSON format). reading them back out of JSON happens lazily in tables.Row.
+# non-ascii stays as it is instead of becoming \u escapes, so master_search can read the artist names
+sqlite3.register_adapter(dict, partial(dumps, ensure_ascii=False))
+sqlite3.register_adapter(list, partial(dumps, ensure_ascii=False))
 
 # connect to SQLite3 Database (just a server file)
-conn = sqlite3.connect('rankings.db', detect_types=sqlite3.PARSE_DECLTYPES)
-
-# set conn return rows as dictionaries which map row names to values
-conn.row_factory = tables.dict_factory
+# all the sqlite work happens on the database's own threads so it never blocks the bot (see tables.Database),
+# rows come back as tables.Row, which can be read like dictionaries that map row names to values
+db = tables.Database('rankings.db', make_rows=tables.make_rows)
 
 # create all table objects for interacting with master table and ranking table
-master_table = tables.MasterTable(conn, spotify)
-rating_table = tables.RatingTable(conn, spotify)
-homework_table = tables.HomeworkTable(conn, spotify)
+master_table = tables.MasterTable(db, spotify)
+rating_table = tables.RatingTable(db, spotify)
+homework_table = tables.HomeworkTable(db, spotify)
+album_stats_table = tables.AlbumStatsTable(db, spotify)
+board_table = tables.BoardTable(db, spotify)
+event_log_table = tables.EventLogTable(db, spotify)
+playlist_table = tables.PlaylistTable(db, spotify)
+
+# upgrades rankings.db to the newest schema (indexes etc.) if it isn't already
+db.run_blocking(migrations.migrate)
 
 # sets up guild/channel/permissions objects for later use
 my_guild = discord.Object(config.guild)
-changelog = Changelog(config.changelog_active, spotify.get_album, config.changelog_channel, set(rating_table.get_users()))
+
+
+# "artist - album name" for the changelog. albums in master_table come straight from its index,
+# anything else (e.g. an album that was just removed) goes through the spotify album cache
+async def describe_album(album_id):
+    if album_id in master_table.indexed_albums:
+        album_name, artist = master_table.indexed_albums[album_id]
+        return f"{artist} - {album_name}"
+    album = await spotify.get_album(album_id=album_id)
+    return f"{', '.join(artist.name for artist in album.artists)} - {album.name}"
+
+
+changelog = Changelog(config.changelog_active, describe_album, config.changelog_channel, set())
+
+
+# what someone's homework playlist gets named after
+async def get_user_name(user_id):
+    user = client.get_user(user_id) or await client.fetch_user(user_id)
+    return user.display_name
+
+
+playlists = PlaylistSyncer(spotify, playlist_table, homework_table, get_user_name, config.playlists_active)
+undoer = Undoer(spotify, master_table, rating_table, homework_table, event_log_table)
 
 
 # syncs global & guild only commands
@@ -65,81 +105,130 @@ async def sync_commands():
     await tree.sync(guild=my_guild)
 
 
-# there will be an error if a final message is over 2000 characters
-# this code will split it up
-def split_message(content):
-    if len(content) <= 2000:
-        return [content]
-    fragments = []
-    while len(content) > 2000:
-        cutoff = content[:2000].rfind('\n')
-        fragments.append(content[:cutoff])
-        content = content[cutoff:].lstrip()
-    fragments.append(content)
-    return fragments
-
-
-# split message, but it does it exactly every 2000 characters instead of finding the nearest newline
-def split_message_rough(content):
-    if len(content) <= 2000:
-        return [content]
-    fragments = []
-    while len(content) > 2000:
-        fragments.append(content[:2000])
-        content = content[2000:].lstrip()
-    fragments.append(content)
-    return fragments
-
-
 # RANKINGS TABLE SECTION----------------------------------------------------------------------------------------------
-# formats the ratings table to a nice string
+# formats the ratings table to a nice string, one line at a time
+# every rating of the year comes from one query (already sorted by user then rating), and users are shown with
+# plain <@id> mentions so we don't need to ask discord who anyone is
 # POSSIBLE MODIFICATION: USE EMBEDS AT THE TOP W/ NICE IMAGES TO MAKE IT LOOK EVEN BETTER
-async def get_rankings_message(year=datetime.now().year):
-    users = rating_table.get_users()
-    final_message = f'# Ratings of {year}\n'
+async def get_rankings_lines(year=datetime.now().year):
+    rows = await rating_table.get_year_ratings(year)
+    yield f'# Ratings of {year}\n'
+    for user_id, user_rows in groupby(rows, key=lambda row: row['user_id']):
+        yield f"## <@{user_id}>'s rankings:\n"
+        for i, row in enumerate(user_rows):
+            yield f'{i + 1}. ' + ", ".join(row['artist']) + f" - {row['album_name']} ({row['rating']})\n"
+        yield '\n'
 
-    # goes through every user who is in rating table  and adds their rankings to final_message
-    for user_id in users:
-        user = await client.fetch_user(user_id)
-        rankings = rating_table.get_user_ratings_formatted(user_id, year)
-        if len(rankings.strip()) == 0:
-            continue
-        final_message += f"## {user.mention}'s rankings:\n{rankings}\n"
 
-    return final_message
+async def get_rankings_fragments(year=datetime.now().year):
+    async def render():
+        return pack_lines([line async for line in get_rankings_lines(year)])
+    return await cached_render(('rankings', year), render)
 
 
-# Updates the rankings channel by deleting all messages then resending them
+# rendered rankings and homework lists, along with the database version they were rendered from.
+# showing them again when nothing has been written since doesn't touch the database at all
+render_cache = LRUCache(maxsize=128)
+
+
+async def cached_render(key, render):
+    # the version has to be read before rendering, in case something gets written while we're rendering
+    version = db.version
+    cached = render_cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    value = await render()
+    render_cache.put(key, (version, value))
+    return value
+
+
+# only one update per year's board at a time, otherwise two updates could both append the same new message
+board_locks = defaultdict(asyncio.Lock)
+
+# caps how many discord calls the boards can have going at once across every channel, so updating a lot of years
+# together doesn't run into discord's global rate limit (discord.py already waits out the per-channel limits)
+board_call_budget = asyncio.Semaphore(5)
+
+
+async def limited(call):
+    async with board_call_budget:
+        return await call
+
+
+# Updates the rankings channel, only editing the messages whose content changed.
+# the ids (and content hashes) of the messages making up each year's board are kept in board_table,
+# new fragments get appended at the end and fragments that aren't needed anymore get deleted from the end
 async def display_rankings(year=datetime.now().year):
     channel_id = config.ranking_channels.get(year)
     if not channel_id:
         raise ValueError(f'error: no channel found for {year}. ask a mod for help.')
 
     channel = client.get_channel(channel_id)
-    final_message = await get_rankings_message(year)
 
-    # deletes all the messages current in the channel (that were made by the bot)
+    async with board_locks[year]:
+        # if the rankings are over 2000 characters and the bot tries to send them, it will encounter an error.
+        # instead, we get an array of <2000 character messages.
+        # (rendered inside the lock, so a render that had to wait can't publish older content over a newer one)
+        fragments = await get_rankings_fragments(year)
+        board = await board_table.get_board(year)
+        # the channel for this year changed in the config, or we've never posted this board before
+        if len(board) == 0 or any(row['channel_id'] != channel_id for row in board):
+            await rebuild_board(year, channel, fragments)
+            return "i successfully updated everyone's album rankings maybe probably"
+
+        messages = []
+        try:
+            for i, fragment in enumerate(fragments):
+                content_hash = board_table.hash_content(fragment)
+                if i >= len(board):
+                    message = await limited(channel.send(fragment))
+                    messages.append((message.id, content_hash))
+                    continue
+                if board[i]['content_hash'] != content_hash:
+                    await limited(channel.get_partial_message(board[i]['message_id']).edit(content=fragment))
+                messages.append((board[i]['message_id'], content_hash))
+            for row in board[len(fragments):]:
+                await limited(channel.get_partial_message(row['message_id']).delete())
+        except discord.NotFound:
+            # somebody deleted one of the board's messages, so start over
+            await rebuild_board(year, channel, fragments)
+            return "i successfully updated everyone's album rankings maybe probably"
+        except Exception:
+            # remember whatever got edited/sent before the error, the rest gets fixed on the next update
+            messages += [(row['message_id'], row['content_hash']) for row in board[len(messages):]]
+            await board_table.save_board(year, channel_id, messages)
+            raise
+        # saving would count as a write and make the rankings render again next time, so skip it if nothing changed
+        if messages != [(row['message_id'], row['content_hash']) for row in board]:
+            await board_table.save_board(year, channel_id, messages)
+    return "i successfully updated everyone's album rankings maybe probably"
+
+
+# deletes all the bot's messages in the channel and sends the board again from scratch
+async def rebuild_board(year, channel, fragments):
     async for message in channel.history():
         if message.author == client.user:
-            await message.delete()
+            await limited(message.delete())
 
-    # if final_message is over 2000 characters and the bot tries to send it, it will encounter an error.
-    # instead, we get an array of <2000 character messages using split_message()
-    fragments = split_message(final_message)
+    messages = []
+    for fragment in fragments:
+        message = await limited(channel.send(fragment))
+        messages.append((message.id, board_table.hash_content(fragment)))
+    await board_table.save_board(year, channel.id, messages)
 
-    # then we just send the fragments
-    for msg in fragments:
-        await channel.send(msg)
-    return "i successfully updated everyone's album rankings maybe probably"
+
+# redraws rankings boards in the background after ratings change (see refresher.py)
+refresher = RankingsRefresher(display_rankings, config.rankings_debounce)
 
 
 # adds a row to ratings table for a given user
-async def add_row(user_id: int, album_id: str, rating: float):
-    album = spotify.get_album(album_id=album_id)
+async def add_row(user_id: int, album, rating: float):
+    rating = ratings_io.check_rating(rating)
+    album_id = album.id
     # attempting to add a row in master row already will NOT return an error, it'll just not add it.
-    master_table.add_row(album)
+    await master_table.add_row(album)
     try:
-        added_rows = rating_table.add_row(album_id, user_id, rating)
+        added_rows = await rating_table.add_row(album_id, user_id, rating)
 
     # checking if any errors are due to primary key constraint,
     # meaning a user tried to add an album to their ratings twice.
@@ -153,7 +242,7 @@ async def add_row(user_id: int, album_id: str, rating: float):
     # NOTE: i repeat the following lines of code 3 times so maybe i should write a function for it,
     # need to decide where it would go, in rating table or here, and what exactly it should do
     album_id = next(iter(added_rows))['album_id']
-    album = next(iter(master_table.get_row(album_id)))
+    album = next(iter(await master_table.get_row(album_id)))
     artist = ", ".join(album['artist'])
     album = album['album_name']
     return f"i successfully added {artist} - {album} to your rankings"
@@ -161,11 +250,12 @@ async def add_row(user_id: int, album_id: str, rating: float):
 
 # edits a row in a given table
 async def edit_row(user_id: int, album_id: str, rating: float):
-    edited_rows = rating_table.edit_row(album_id, user_id, rating)
+    rating = ratings_io.check_rating(rating)
+    edited_rows = await rating_table.edit_row(album_id, user_id, rating)
     if len(edited_rows) == 0:
         raise LookupError("error: no rows were edited, which is confusing idk why that happened")
     album_id = next(iter(edited_rows))['album_id']
-    album = next(iter(master_table.get_row(album_id)))
+    album = next(iter(await master_table.get_row(album_id)))
     artist = ", ".join(album['artist'])
     album = album['album_name']
     return f"i successfully edited {artist} - {album} to a {rating}/10.0"
@@ -173,67 +263,102 @@ async def edit_row(user_id: int, album_id: str, rating: float):
 
 # removes a row from a certain users table
 async def remove_row(user_id, album_id):
-    removed_rows = rating_table.remove_row(album_id, user_id)
-    if removed_rows is None:
+    # grab the album first, the album might get removed from master_table along with its last rating
+    album = next(iter(await master_table.get_row(album_id)), None)
+    removed_rows = await rating_table.remove_row(album_id, user_id)
+    await master_table.prune_index(album_id)
+    if not removed_rows or album is None:
         raise LookupError("error: no rows were deleted, whyy?????")
-    album_id = next(iter(removed_rows))['album_id']
-    album = next(iter(master_table.get_row(album_id)))
     artist = ", ".join(album['artist'])
     album = album['album_name']
     return f"i successfully deleted {artist} - {album} from your list"
 
 
+# EVENT LOG SECTION-----------------------------------------------------------------------------------------------------
+# how each kind of event shows up in /history, {album} is "artist - album name"
+EVENT_DESCRIPTIONS = {
+    'rating_add': 'rated {album} a {new_value}',
+    'rating_edit': 'changed {album} from a {old_value} to a {new_value}',
+    'rating_remove': 'removed {album} (was a {old_value})',
+    'homework_add': 'got {album} as homework',
+    'homework_remove': 'finished/removed {album} from homework',
+}
+
+
+async def describe_event(event):
+    # events straight from event_log_table.get_events come with the album's name (if it's still in master_table)
+    if event.get('album_name') is not None:
+        album = f"{', '.join(event['artist'])} - {event['album_name']}"
+    else:
+        album = await describe_album(event['album_id'])
+    return EVENT_DESCRIPTIONS[event['action']].format(album=album, old_value=event['old_value'],
+                                                      new_value=event['new_value'])
+
+
+async def get_history_formatted(user, before: int = None, limit: int = 15):
+    events = await event_log_table.get_events(user.id, before, limit)
+    if not events:
+        return f"{user.mention} doesn't have any {'older ' if before else ''}history"
+    descriptions = await asyncio.gather(*[describe_event(event) for event in events])
+    output = f"## History of {user.mention}"
+    for event, description in zip(events, descriptions):
+        output += f"\n`#{event['event_id']}` <t:{event['time']}:R> {description}"
+        if event['undone']:
+            output += " (undone)"
+        elif event['undo_of'] is not None:
+            output += f" (undo of #{event['undo_of']})"
+    if len(events) == limit:
+        output += f"\n\nolder changes: /history before:{events[-1]['event_id']}"
+    return output
+
+
 # ALBUM STATS SECTION---------------------------------------------------------------------------------------------------
 
-# get album rankings, and then run some simple statistics (could add more statistics)
-def get_album_stats(album_id):
-    data = master_table.get_row(album_id)
+# gets the album's running stats from album_stats and formats them (could add more statistics)
+async def get_album_stats(album_id):
+    data = await master_table.get_row(album_id)
     if len(data) == 0:
         raise LookupError("error: no albums found, potentially because you didn't select an autocomplete option")
 
     album_row = next(iter(data))
-    ratings = tuple([rating['rating'] for rating in rating_table.get_single_album_ratings(album_id)])
-    num_ratings = len(ratings)
+    aggregate = await album_stats_table.get_album_aggregate(album_id)
+    num_ratings = aggregate['num_ratings'] if aggregate is not None else 0
     if num_ratings == 0:
         raise ValueError("error: This album has no ratings")
 
-    mean = round(statistics.mean(ratings), 2)
+    mean = round(aggregate['mean'], 2)
     artist = ", ".join(album_row['artist'])
     final_string = f"Artist: {artist}\nAlbum: {album_row['album_name']}\nNumber of Ratings: {num_ratings}\nMean: {mean}"
     if num_ratings > 1:
-        std_deviation = round(statistics.stdev(ratings), 2)
+        std_deviation = round(sqrt(max(aggregate['variance'], 0)), 2)
         final_string += f"\nStandard Deviation: {std_deviation}"
     return final_string
 
 
-# this will get the grouped ratings of every single album and return a list of dictionaries.
-# dictionaries include the key 'ratings' which has all the ratings for the album.
-# dictionaries also have the key 'statistic' to access whatever statistic was requested.
-def get_top_albums(top_number: int, min_ratings: int, year: int, sort_by: str):
-    all_ratings = [album for album in rating_table.get_grouped_ratings()
-                   if len(album['ratings']) >= min_ratings and (year == -1 or year == album['year'])]
-
+# gets the top albums from album_stats (filtering, sorting and limiting all happens in sqlite) and returns a list of dictionaries.
+# dictionaries have the key 'statistic' to access whatever statistic was requested.
+async def get_top_albums(top_number: int, min_ratings: int, year: int, sort_by: str):
     # error raising for invalid parameters
-    if len(all_ratings) == 0:
+    if top_number <= 0:
+        raise ValueError("error: not enough albums to rank (or you entered a negative value)")
+    if "avg" not in sort_by and min_ratings < 2:
+        raise Exception("error: you cannot sort by standard deviation if minimum ratings is set to less than 2")
+
+    top_albums = await album_stats_table.get_album_aggregates(year=year, min_ratings=min_ratings, sort_by=sort_by, limit=top_number)
+    if len(top_albums) == 0:
         raise ValueError("error: no albums found that meet the conditions required")
-    if 0 < top_number and top_number > len(all_ratings):
+    if top_number > len(top_albums):
         raise ValueError("error: not enough albums to rank (or you entered a negative value)")
 
+    # rounded like get_album_stats, the running stats pick up float drift (8.500000000000002)
     if "avg" in sort_by:
-        ratings_with_stat = [{**album, 'statistic': statistics.mean(album['ratings'])} for album in all_ratings]
-        sorted_list = list(sorted(ratings_with_stat, key=lambda x: x['statistic'], reverse=True))
-    else:
-        if min_ratings < 2:
-            raise Exception("error: you cannot sort by standard deviation if minimum ratings is set to less than 2")
-        ratings_with_stat = [{**album, 'statistic': statistics.stdev(album['ratings'])} for album in all_ratings]
-        sorted_list = list(sorted(ratings_with_stat, key=lambda x: x['statistic']))
-
-    return sorted_list[:top_number]
+        return [{**album, 'statistic': round(album['mean'], 2)} for album in top_albums]
+    return [{**album, 'statistic': round(sqrt(max(album['variance'], 0)), 2)} for album in top_albums]
 
 
 # formats output from get_top_albums into a message
-def get_top_albums_formatted(top_number: int = 5, min_ratings: int = 2, year: int = -1, sortby: str = "avg"):
-    rankings = get_top_albums(top_number, min_ratings, year, sortby)
+async def get_top_albums_formatted(top_number: int = 5, min_ratings: int = 2, year: int = -1, sortby: str = "avg"):
+    rankings = await get_top_albums(top_number, min_ratings, year, sortby)
     if 'avg' in sortby:
         final_string = f"## Top {top_number} albums with at least {min_ratings} rating(s) according to average:"
     else:
@@ -243,6 +368,17 @@ def get_top_albums_formatted(top_number: int = 5, min_ratings: int = 2, year: in
     return final_string
 
 
+# runs once before the bot connects to discord, for startup work that needs the event loop
+@client.event
+async def setup_hook():
+    # recompute the stats of albums rated since last time in case anything drifted (everything if the table is new)
+    await album_stats_table.repair()
+    changelog.users.update(await rating_table.get_users())
+    await master_table.load_index()
+    # catch up on any homework playlists that missed a change (anything already in sync is skipped without spotify)
+    playlists.request(*await homework_table.get_users())
+
+
 # whenever the bot is ready, it'll run this, initiating the changelog properly since client is now ready
 # and changing the discord presence (because it's cool)
 @client.event
@@ -260,9 +396,27 @@ async def update(interaction: discord.Interaction):
     try:
         await interaction.response.defer()
         await master_table.update_master_table(rating_table, homework_table)
-        for year in config.ranking_channels:
+        rating_table.clear_user_cache()
+        homework_table.clear_user_cache()
+
+        # every year's board gets updated at the same time (each board's messages still go out in order)
+        years = list(config.ranking_channels)
+        progress = await interaction.followup.send(f'updating the rankings for {len(years)} years...', wait=True)
+        updated = []
+
+        async def update_year(year):
             await display_rankings(year)
-        await interaction.followup.send('i probably updated the entire bot hopefully')
+            updated.append(year)
+            await progress.edit(content=f'updated {len(updated)}/{len(years)} years of rankings...')
+
+        results = await asyncio.gather(*[update_year(year) for year in years], return_exceptions=True)
+        failed = [year for year, result in zip(years, results) if isinstance(result, Exception)]
+        for result in results:
+            if isinstance(result, Exception):
+                print_exception(result)
+        if failed:
+            raise ValueError(f"error: couldn't update the rankings for {', '.join(map(str, failed))}")
+        await progress.edit(content='i probably updated the entire bot hopefully')
     except Exception as error:
         print_exc()
         await interaction.followup.send(content=error)
@@ -274,8 +428,7 @@ async def update(interaction: discord.Interaction):
 async def get_ratings(interaction: discord.Interaction, year: int = datetime.now().year):
     try:
         await interaction.response.defer()
-        message = await get_rankings_message(year=year)
-        messages = split_message(message)
+        messages = await get_rankings_fragments(year=year)
         await interaction.followup.send(messages[0])
         [await interaction.channel.send(content=i) for i in messages[1:]]
     except Exception as error:
@@ -290,20 +443,19 @@ async def get_ratings(interaction: discord.Interaction, year: int = datetime.now
 @app_commands.rename(album_id='entry')
 async def add(interaction: discord.Interaction, album_id: str, rating: float):
     try:
-        album = spotify.get_album(album_id=album_id)
-        await interaction.response.send_message(await add_row(album_id=album_id,
-                                                              user_id=interaction.user.id,
-                                                              rating=rating))
-        # Remove from the homework, if it exists there
-        homework_table.remove_homework(interaction.user.id, album_id)
-        # spotify api is broken with playlists, will comment out until fix is found
-        # spotify.remove_album_from_playlist(interaction.user, album_id)
-
-        year = datetime.fromisoformat(album.release_date).year
+        album = await spotify.get_album(album_id=album_id)
+        # adding the album, adding the rating and removing the homework all get committed together (or not at all)
+        async with rating_table.transaction():
+            message = await add_row(album=album, user_id=interaction.user.id, rating=rating)
+            # Remove from the homework, if it exists there
+            await homework_table.remove_homework(interaction.user.id, album_id)
+        await interaction.response.send_message(message)
+        playlists.request(interaction.user.id)
+
+        year = release_year(album)
         if year in config.ranking_channels:
-            await display_rankings(year)
-        await changelog.event_add_ranking(interaction.user, album_id, rating)
-        await master_table.update_master_table(rating_table, homework_table)
+            refresher.request(year)
+        changelog.event_add_ranking(interaction.user, album_id, rating)
     except Exception as error:
         print_exc()
         await interaction.followup.send(content=error)
@@ -317,15 +469,15 @@ async def add(interaction: discord.Interaction, album_id: str, rating: float):
 @app_commands.autocomplete(album_id=ac.autocomplete_artist_album_user_specific(rating_table.get_users_ratings))
 async def edit(interaction: discord.Interaction, album_id: str, rating: float):
     try:
-        old_rating = rating_table.get_single_rating(interaction.user.id, album_id)
+        old_rating = await rating_table.get_single_rating(interaction.user.id, album_id)
         if len(old_rating) == 0:
             raise ValueError("error: you cannot edit a rating that isnt on your list")
         await interaction.response.send_message(await edit_row(interaction.user.id, album_id, rating))
 
         year = next(iter(old_rating))['year']
         if year in config.ranking_channels:
-            await display_rankings(year)
-        await changelog.event_edit_ranking(user=interaction.user, album_id=album_id, old_rating=old_rating['rating'], new_rating=rating)
+            refresher.request(year)
+        changelog.event_edit_ranking(user=interaction.user, album_id=album_id, old_rating=next(iter(old_rating))['rating'], new_rating=rating)
     except Exception as error:
         print_exc()
         await interaction.followup.send(content=error)
@@ -338,16 +490,15 @@ async def edit(interaction: discord.Interaction, album_id: str, rating: float):
 @app_commands.autocomplete(album_id=ac.autocomplete_artist_album_user_specific(rating_table.get_users_ratings))
 async def remove(interaction: discord.Interaction, album_id: str):
     try:
-        old_rating = rating_table.get_single_rating(interaction.user.id, album_id)
+        old_rating = await rating_table.get_single_rating(interaction.user.id, album_id)
         if len(old_rating) == 0:
             raise ValueError("error, you cannot remove a row that doesnt exist in your rankings")
         await interaction.response.send_message(await remove_row(interaction.user.id, album_id))
 
         year = next(iter(old_rating))['year']
         if year in config.ranking_channels:
-            await display_rankings(year)
-        await changelog.event_remove_ranking(interaction.user, album_id)
-        await master_table.update_master_table(rating_table, homework_table)
+            refresher.request(year)
+        changelog.event_remove_ranking(interaction.user, album_id)
     except Exception as error:
         print_exc()
         await interaction.followup.send(content=error)
@@ -360,7 +511,7 @@ async def remove(interaction: discord.Interaction, album_id: str):
 @app_commands.autocomplete(album_id=ac.autocomplete_spotify(spotify.search_album))
 async def cover(interaction: discord.Interaction, album_id: str):
     try:
-        album = spotify.get_album(album_id=album_id)
+        album = await spotify.get_album(album_id=album_id)
         artists = [artist.name for artist in album.artists]
         embed = discord.Embed(title=album, description=f"by " + ", ".join(artists) + f" - {album.release_date}")
         embed.set_image(url=album.images[0].url)
@@ -374,32 +525,49 @@ async def cover(interaction: discord.Interaction, album_id: str):
 @tree.command(name='stats', description='find out stats about an album', guild=my_guild)
 @app_commands.describe(album_id="the artist - album you are trying to get (see autocomplete)")
 @app_commands.rename(album_id='entry')
-@app_commands.autocomplete(album_id=ac.autocomplete_artist_album(master_table.get_full_table))
+@app_commands.autocomplete(album_id=ac.autocomplete_artist_album(master_table.album_index))
 async def stats(interaction: discord.Interaction, album_id: str):
     try:
-        album = spotify.get_album(album_id=album_id)
-        if rating_table.get_single_rating(interaction.user.id, album_id) is None:
-            raise ValueError("error: you cannot get stats for an album that is not ranked by anyone")
-        album_cover = album.images[0].url
-        embed = discord.Embed(title=album.name, description=get_album_stats(album_id=album_id))
-        embed.set_image(url=album_cover)
+        # everything we need is already in master_table, so no need to ask spotify
+        album_row = next(iter(await master_table.get_row(album_id)), None)
+        if album_row is None:
+            raise LookupError("error: no albums found, potentially because you didn't select an autocomplete option")
+        embed = discord.Embed(title=album_row['album_name'], description=await get_album_stats(album_id=album_id))
+        embed.set_image(url=album_row['album_cover_url'])
         await interaction.response.send_message(embed=embed)
     except Exception as error:
         print_exc()
         await interaction.followup.send(content=error)
 
 
+# SEARCH COMMAND - searches every album anyone has rated or has as homework
+@tree.command(name='search', description='search the albums everyone has rated or has as homework', guild=my_guild)
+@app_commands.describe(query="words from the album name or artist (the start of a word is enough)")
+async def search(interaction: discord.Interaction, query: str):
+    try:
+        results = await master_table.search(query, limit=15)
+        if not results:
+            raise LookupError(f"error: no albums found for {query}")
+        final_string = f"# Search results for {query}"
+        for row in results:
+            final_string += f"\n{', '.join(row['artist'])} - {row['album_name']} ({row['year']})"
+        await interaction.response.send_message(split_message(final_string)[0])
+    except Exception as error:
+        print_exc()
+        await interaction.followup.send(content=error)
+
+
 @tree.command(name='top-albums', description='find the top albums of the year (or any year) '
                                              '(refresh autocomplete by changing text channels)', guild=my_guild)
 @app_commands.describe(numberofalbums="how many albums do you want to see ranked? (default: 5)",
                        minimumratings="how many rankings do you want the album to have minimum (default: 1)",
                        year="the year you want to filter by, -1 for no filtering")
-@app_commands.autocomplete(numberofalbums=ac.autocomplete_top_albums_numalbums(rating_table.get_full_table),
-                           minimumratings=ac.autocomplete_top_albums_minratings(rating_table.get_full_table))
+@app_commands.autocomplete(numberofalbums=ac.autocomplete_top_albums_numalbums(album_stats_table.get_rating_counts),
+                           minimumratings=ac.autocomplete_top_albums_minratings(album_stats_table.get_rating_counts))
 @app_commands.choices(sortby=[Choice(name='average', value='avg'), Choice(name='standard deviation', value='std')])
 async def top_albums(interaction: discord.Interaction, numberofalbums: int = 5, minimumratings: int = 1, sortby: str = 'avg', year: int = datetime.now().year):
     try:
-        await interaction.response.send_message(get_top_albums_formatted(numberofalbums, minimumratings, year, sortby))
+        await interaction.response.send_message(await get_top_albums_formatted(numberofalbums, minimumratings, year, sortby))
     except Exception as error:
         print_exc()
         await interaction.followup.send(content=error)
@@ -414,18 +582,19 @@ async def top_albums(interaction: discord.Interaction, numberofalbums: int = 5,
 async def add_homework(interaction: discord.Interaction, album_id: str, user: discord.User = None):
     try:
         await interaction.response.defer()
-        album = spotify.get_album(album_id=album_id)
+        album = await spotify.get_album(album_id=album_id)
         if user is None:
             user = interaction.user
         # Don't add it if user has already rated it
         artists = ", ".join([artist.name for artist in album.artists])
-        if rating_table.get_single_rating(user.id, album_id) is not None:
+        if len(await rating_table.get_single_rating(user.id, album_id)) != 0:
             raise ValueError(f"error: {user.mention} has already listened to {artists} - {album.name}")
-        homework_table.add_homework(user.id, album_id)
-        # adding song to spotify playlist is broken with current version of our spotify api wrapper
-        # spotify.add_album_to_playlist(user, album_id)
+        async with homework_table.transaction():
+            await master_table.add_row(album)
+            await homework_table.add_homework(user.id, album_id)
+        playlists.request(user.id)
         await interaction.followup.send(f"i successfully added {artists} - {album.name} to {user.mention}'s homework")
-        await changelog.event_add_homework(interaction.user, album_id, user)
+        changelog.event_add_homework(interaction.user, album_id, user)
     except Exception as error:
         print_exc()
         await interaction.followup.send(error)
@@ -439,12 +608,11 @@ async def get_homework(interaction: discord.Interaction, user: discord.User = No
         await interaction.response.defer()
         if user is None:
             user = interaction.user
-        fragments = split_message(homework_table.get_homework_formatted(user))
+        homework = await cached_render(('homework', user.id), lambda: homework_table.get_homework_formatted(user))
+        fragments = split_message(homework)
         await interaction.followup.send(fragments[0], suppress_embeds=True)
         for msg in fragments[1:]:
             await interaction.channel.send(msg, suppress_embeds=True)
-        await master_table.update_master_table(rating_table, homework_table)
-
     except Exception as error:
         print_exc()
         await interaction.followup.send(error)
@@ -454,13 +622,14 @@ async def get_homework(interaction: discord.Interaction, user: discord.User = No
 @tree.command(name='remove-homework', description='remove homework from your list', guild=my_guild)
 @app_commands.rename(album_id='entry')
 @app_commands.describe(album_id="the artist - album you are trying to remove from your list (see autocomplete)")
-@app_commands.autocomplete(album_id=ac.autocomplete_artist_album_homework_specific(homework_table.get_homework, conn))
+@app_commands.autocomplete(album_id=ac.autocomplete_artist_album_homework_specific(homework_table.get_homework))
 async def remove_homework(interaction: discord.Interaction, album_id: str):
     try:
         # fetches album from album_master and deletes it from the users homework table
-        await interaction.response.send_message(content=homework_table.remove_homework(interaction.user.id, album_id), suppress_embeds=True)
-        await master_table.update_master_table(rating_table, homework_table)
-        await changelog.event_finish_homework(interaction.user, album_id)
+        await interaction.response.send_message(content=await homework_table.remove_homework(interaction.user.id, album_id), suppress_embeds=True)
+        await master_table.prune_index(album_id)
+        playlists.request(interaction.user.id)
+        changelog.event_finish_homework(interaction.user, album_id)
     except Exception as error:
         print_exc()
         await interaction.followup.send(content=error)
@@ -474,30 +643,156 @@ async def remove_homework(interaction: discord.Interaction, album_id: str):
 async def add_all_homework(interaction: discord.Interaction, album_id: str):
     try:
         await interaction.response.defer()
-        album = spotify.get_album(album_id=album_id)
-        await master_table.add_row(album)
-        # gets all users and adds a specific album to their homework
-        added = 0
-        for user in rating_table.get_users():
-            try:
-                homework_table.add_homework(user.id, album_id)
-                added += 1
-                user_obj = await client.fetch_user(user)
-                # spotify playlists are broken so this will be commented out until a fix is found
-                # spotify.add_album_to_playlist(user_obj, album_id)
-                await changelog.event_add_homework(user_obj, album_id, user_obj)
-            except ValueError:
-                pass
-            except Exception as error:
-                raise error
+        album = await spotify.get_album(album_id=album_id)
+        # adds the album to everyones homework (except people who've rated it already) in one transaction
+        async with homework_table.transaction():
+            await master_table.add_row(album)
+            added_users = await homework_table.add_homework_for_everyone(album_id)
+            if not added_users:
+                raise ValueError("error: everyone already has that album as homework or has rated it")
+        playlists.request(*added_users)
+        # one changelog entry for everyone instead of one per user
+        changelog.event_add_homework_bulk(interaction.user, album_id, added_users)
         artists = ", ".join([artist.name for artist in album.artists])
-        await interaction.followup.send(content=f"i successfully added {artists} - {album.name} to {added} users homework")
-        await master_table.update_master_table(rating_table, homework_table)
+        await interaction.followup.send(content=f"i successfully added {artists} - {album.name} to {len(added_users)} users homework")
     except Exception as error:
         print_exc()
         await interaction.followup.send(error)
 
 
+# IMPORT RATINGS COMMAND - adds a whole file of ratings at once (csv/json, the same format /export-ratings gives you)
+@tree.command(name='import-ratings', description='add a bunch of ratings at once from a csv or json file', guild=my_guild)
+@app_commands.describe(file="csv or json file with album_id (or spotify link) and rating for each album",
+                       overwrite="replace ratings you already have with the ones in the file (default keeps yours)")
+async def import_ratings(interaction: discord.Interaction, file: discord.Attachment, overwrite: bool = False):
+    try:
+        await interaction.response.defer()
+        if file.size > ratings_io.MAX_IMPORT_BYTES:
+            raise ValueError(f"error: that file is too big (max {ratings_io.MAX_IMPORT_BYTES // 1000} KB)")
+        ratings, problems = ratings_io.parse_ratings((await file.read()).decode('utf-8-sig'), file.filename)
+        if not ratings:
+            raise ValueError("error: i couldn't find any ratings in that file" + ratings_io.format_problems(problems))
+
+        # every album in one go (cached albums are free, the rest get fetched from spotify in batches)
+        fetched = await spotify.get_albums(list(ratings))
+        fetched_ids = {album.id for album in fetched}
+        problems += [f"{album_id}: spotify doesn't know this album" for album_id in ratings if album_id not in fetched_ids]
+        # an album without a release year can't go in master_table, so it gets skipped instead of sinking the import
+        albums = [album for album in fetched if album.release_date[:4].isdigit()]
+        problems += [f"{album.id}: spotify doesn't say when {album.name} came out" for album in fetched
+                     if not album.release_date[:4].isdigit()]
+        found = {album.id for album in albums}
+        user_id = interaction.user.id
+        async with rating_table.transaction():
+            await master_table.add_rows(albums)
+            added, changed = await rating_table.add_rows(
+                user_id, {album_id: rating for album_id, rating in ratings.items() if album_id in found}, overwrite)
+            # same as /add-rating, rating something takes it off your homework
+            await homework_table.remove_many(user_id, list(found))
+        kept = len(found) - added - changed
+        playlists.request(user_id)
+
+        # each year's board gets redrawn once for the whole import
+        for year in {release_year(album) for album in albums}:
+            if year in config.ranking_channels:
+                refresher.request(year)
+        if added or changed:
+            changelog.event_add_bulk(interaction.user)
+        message = f"i imported {added} new ratings"
+        if changed:
+            message += f" and changed {changed}"
+        if kept:
+            message += f" ({kept} were already on your list{' with the same rating' if overwrite else ''})"
+        for fragment in split_message(message + ratings_io.format_problems(problems)):
+            await interaction.followup.send(fragment, suppress_embeds=True)
+    except Exception as error:
+        print_exc()
+        await interaction.followup.send(content=error)
+
+
+# EXPORT RATINGS COMMAND - sends someone's ratings as a file (which /import-ratings can read back in)
+@tree.command(name='export-ratings', description="download someone's ratings as a csv or json file", guild=my_guild)
+@app_commands.describe(user="the user whose ratings you want", file_format="csv (default) or json")
+async def export_ratings(interaction: discord.Interaction, user: discord.User = None,
+                         file_format: Literal['csv', 'json'] = 'csv'):
+    try:
+        await interaction.response.defer()
+        if user is None:
+            user = interaction.user
+        data = await ratings_io.write_ratings(rating_table.iter_users_ratings(user.id), file_format == 'json')
+        await interaction.followup.send(f"here are {user.mention}'s ratings",
+                                        file=discord.File(BytesIO(data), filename=f'ratings_{user.name}.{file_format}'),
+                                        allowed_mentions=discord.AllowedMentions.none())
+    except Exception as error:
+        print_exc()
+        await interaction.followup.send(content=error)
+
+
+# REBUILD STATS COMMAND - recomputes album_stats from rating_table, in case the running stats ever drift
+@tree.command(name='rebuild-stats', description='MOD ONLY: recomputes album stats from every rating', guild=my_guild)
+@app_commands.checks.has_role(config.mod_id)
+async def rebuild_stats(interaction: discord.Interaction):
+    try:
+        await interaction.response.defer()
+        num_albums = await album_stats_table.rebuild()
+        await interaction.followup.send(content=f"i rebuilt the stats for {num_albums} albums")
+    except Exception as error:
+        print_exc()
+        await interaction.followup.send(content=error)
+
+
+# HISTORY COMMAND - shows someone's recent rating/homework changes (newest first) from the event log
+@tree.command(name='history', description="see someone's recent rating and homework changes", guild=my_guild)
+@app_commands.describe(user="the user whose changes you want to see",
+                       before="only show changes older than this number (the # next to each change)")
+async def history(interaction: discord.Interaction, user: discord.User = None, before: int = None):
+    try:
+        await interaction.response.defer()
+        if user is None:
+            user = interaction.user
+        await interaction.followup.send(await get_history_formatted(user, before), suppress_embeds=True,
+                                        allowed_mentions=discord.AllowedMentions.none())
+    except Exception as error:
+        print_exc()
+        await interaction.followup.send(content=error)
+
+
+# UNDO COMMAND - undoes your most recent rating/homework change, use it again to keep going back
+@tree.command(name='undo', description='undo your most recent rating or homework change', guild=my_guild)
+async def undo(interaction: discord.Interaction):
+    try:
+        await interaction.response.defer()
+        events, albums = await undoer.undo_last_event(interaction.user.id)
+        descriptions = await asyncio.gather(*[describe_event(event) for event in events])
+        message = "i undid " + "\n".join(f"`#{event['event_id']}`: you {description}"
+                                         for event, description in zip(events, descriptions))
+        for fragment in split_message(message):
+            await interaction.followup.send(fragment, suppress_embeds=True)
+
+        years = set()
+        for event in events:
+            action, album_id = event['action'], event['album_id']
+            if action.startswith('rating') and album_id in albums:
+                years.add(release_year(albums[album_id]))
+            if action == 'rating_add':
+                changelog.event_remove_ranking(interaction.user, album_id)
+            elif action == 'rating_edit':
+                changelog.event_edit_ranking(interaction.user, album_id, event['new_value'], event['old_value'])
+            elif action == 'rating_remove':
+                changelog.event_add_ranking(interaction.user, album_id, event['old_value'])
+            elif action == 'homework_add':
+                changelog.event_finish_homework(interaction.user, album_id)
+            else:
+                changelog.event_add_homework(interaction.user, album_id, interaction.user)
+        for year in years & config.ranking_channels.keys():
+            refresher.request(year)
+        if any(event['action'].startswith('homework') for event in events):
+            playlists.request(interaction.user.id)
+    except Exception as error:
+        print_exc()
+        await interaction.followup.send(content=error)
+
+
 # SYNC COMMAND - calls tree.sync to sync new changes to application commands
 @tree.command(name='sync', description='MOD ONLY: syncs the application commands')
 @app_commands.checks.has_role(config.mod_id)
@@ -506,6 +801,8 @@ async def sync(interaction: discord.Interaction):
         await interaction.response.defer()
         await sync_commands()
         await master_table.update_master_table(rating_table, homework_table)
+        rating_table.clear_user_cache()
+        homework_table.clear_user_cache()
         await interaction.followup.send(content="sync successful")
     except Exception as error:
         await interaction.followup.send(content=error)
@@ -516,6 +813,5 @@ if __name__ == '__main__':
     client.run(TOKEN)
 
     # these lines should run after bots event loop is stopped
-    conn.commit()
-    conn.close()
+    db.close()
     spotify.close_spotify_conn()
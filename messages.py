@@ -0,0 +1,43 @@
+# helpers for fitting text into discord messages, which can't be longer than 2000 characters
+
+MESSAGE_LIMIT = 2000
+
+
+# there will be an error if a final message is over 2000 characters
+# this code will split it up
+def split_message(content):
+    if len(content) <= 2000:
+        return [content]
+    fragments = []
+    while len(content) > 2000:
+        cutoff = content[:2000].rfind('\n')
+        fragments.append(content[:cutoff])
+        content = content[cutoff:].lstrip()
+    fragments.append(content)
+    return fragments
+
+
+# split message, but it does it exactly every 2000 characters instead of finding the nearest newline
+def split_message_rough(content):
+    if len(content) <= 2000:
+        return [content]
+    fragments = []
+    while len(content) > 2000:
+        fragments.append(content[:2000])
+        content = content[2000:].lstrip()
+    fragments.append(content)
+    return fragments
+
+
+# packs lines into as few <2000 character messages as possible, without splitting a line across messages
+def pack_lines(lines, limit=MESSAGE_LIMIT):
+    fragments = []
+    fragment = ''
+    for line in lines:
+        if len(fragment) + len(line) > limit:
+            fragments += split_message_rough(fragment.rstrip())
+            fragment = line.lstrip()
+        else:
+            fragment += line
+    fragments += split_message_rough(fragment.rstrip())
+    return [fragment for fragment in fragments if fragment]
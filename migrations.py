@@ -0,0 +1,95 @@
+import sqlite3
+
+# schema changes for rankings.db go here, so databases that already exist get upgraded automatically on startup.
+# the version of a database is stored in PRAGMA user_version, and every migration after that version gets run
+# (each one in its own transaction). NEVER edit or reorder a migration that has already shipped, just add a new one
+# to the end of the list. the tables themselves are still created by the table classes in tables.py
+
+
+MIGRATIONS = [
+    # 1: indexes for the queries that run all the time (get_users_ratings, get_homework, and the year filters)
+    ('CREATE INDEX IF NOT EXISTS rating_table_user_id ON rating_table (user_id)',
+     'CREATE INDEX IF NOT EXISTS homework_table_user_id_complete ON homework_table (user_id, complete)',
+     'CREATE INDEX IF NOT EXISTS master_table_year ON master_table (year)'),
+    # 2: full text search over album names and artists (see MasterTable.search).
+    # it's an external content table, so the text itself stays in master_table and only the index is stored here.
+    # the triggers keep it in sync with master_table, and 'rebuild' indexes whatever is already there
+    ("""CREATE VIRTUAL TABLE IF NOT EXISTS master_search USING fts5(album_name, artist,
+     content='master_table', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2', prefix='2 3')""",
+     """CREATE TRIGGER IF NOT EXISTS master_search_insert AFTER INSERT ON master_table
+     BEGIN
+         INSERT INTO master_search (rowid, album_name, artist) VALUES (NEW.rowid, NEW.album_name, NEW.artist);
+     END""",
+     """CREATE TRIGGER IF NOT EXISTS master_search_delete AFTER DELETE ON master_table
+     BEGIN
+         INSERT INTO master_search (master_search, rowid, album_name, artist)
+         VALUES ('delete', OLD.rowid, OLD.album_name, OLD.artist);
+     END""",
+     """CREATE TRIGGER IF NOT EXISTS master_search_update AFTER UPDATE ON master_table
+     BEGIN
+         INSERT INTO master_search (master_search, rowid, album_name, artist)
+         VALUES ('delete', OLD.rowid, OLD.album_name, OLD.artist);
+         INSERT INTO master_search (rowid, album_name, artist) VALUES (NEW.rowid, NEW.album_name, NEW.artist);
+     END""",
+     "INSERT INTO master_search (master_search) VALUES ('rebuild')"),
+    # 3: /history and /undo look at one user's newest events (see EventLogTable)
+    ('CREATE INDEX IF NOT EXISTS event_log_user_id ON event_log (user_id, event_id)',),
+    # 4: artists used to be stored with non-ascii letters as \u escapes, which master_search indexed as they were
+    # ("Sigur R\u00f3s" became the words "sigur", "r" and "u00f3s"). json_group_array writes them back unescaped,
+    # and master_search_update reindexes every row that changes
+    ("""UPDATE master_table SET artist =
+     (SELECT json_group_array(value) FROM (SELECT value FROM json_each(master_table.artist) ORDER BY key))
+     WHERE instr(artist, '\\u') > 0""",
+     "INSERT INTO master_search (master_search) VALUES ('rebuild')"),
+]
+
+# pragmas only last as long as the connection, so these get set every time we connect.
+# WAL lets reads happen while something is writing, and synchronous=NORMAL is safe with WAL
+# while only needing an fsync at checkpoints instead of on every commit
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA busy_timeout = 5000',
+)
+
+# read only connections can't change the journal mode, and should never write anything
+READ_ONLY_PRAGMAS = (
+    'PRAGMA query_only = ON',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA busy_timeout = 5000',
+)
+
+
+def configure_connection(conn: sqlite3.Connection, read_only: bool = False):
+    for pragma in READ_ONLY_PRAGMAS if read_only else PRAGMAS:
+        conn.execute(pragma)
+
+
+def get_version(conn: sqlite3.Connection) -> int:
+    # plain cursor so this works no matter what row_factory the connection uses
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    version = cursor.execute('PRAGMA user_version').fetchone()[0]
+    cursor.close()
+    return version
+
+
+# brings the database up to the newest version, returns the version it ended up on
+def migrate(conn: sqlite3.Connection) -> int:
+    version = get_version(conn)
+    for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute('BEGIN')
+        try:
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            print(f'error: migration {number} failed, database left at version {number - 1}')
+            raise
+        print(f'migrated rankings.db to version {number}')
+    return len(MIGRATIONS)
@@ -0,0 +1,70 @@
+import asyncio
+from dataclasses import dataclass, field
+from traceback import print_exception
+from typing import Callable
+from spotify_integration import Spotify
+from tables import HomeworkTable, PlaylistTable
+
+# keeps everyone's homework playlist on spotify in line with their homework list, in the background.
+# commands just say whose homework changed (request), and after a few seconds the syncer works out what each of
+# those playlists should hold and sends spotify only the difference (see Spotify.sync_playlist).
+# the playlist ids live in playlist_table, so spotify's list of playlists only gets searched the first time.
+# if someone's homework albums hash the same as the last successful sync, spotify isn't asked anything at all
+
+
+@dataclass
+class PlaylistSyncer:
+    spotify: Spotify
+    playlist_table: PlaylistTable
+    homework_table: HomeworkTable
+    # async function that turns a user_id into the name their playlist is called after
+    get_user_name: Callable
+    active: bool = True
+    # seconds to wait for more changes before syncing (add-all-homework changes everyone at once)
+    delay: float = 5.0
+    # how many playlists can sync at once, kept low so autocomplete still gets spotify threads
+    max_syncs: int = 2
+    dirty: set[int] = field(default_factory=set)
+    task: asyncio.Task | None = None
+
+    def __post_init__(self):
+        self.sync_limit = asyncio.Semaphore(self.max_syncs)
+
+    def request(self, *user_ids: int):
+        if not self.active:
+            return
+        self.dirty.update(user_ids)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        await asyncio.sleep(self.delay)
+        # anything requested while a round is going gets picked up by the next round
+        while self.dirty:
+            user_ids = list(self.dirty)
+            self.dirty.clear()
+            results = await asyncio.gather(*[self.sync_user(user_id) for user_id in user_ids], return_exceptions=True)
+            for user_id, result in zip(user_ids, results):
+                if isinstance(result, Exception):
+                    print(f'error: could not sync the homework playlist of {user_id}')
+                    print_exception(result)
+
+    async def sync_user(self, user_id: int):
+        async with self.sync_limit:
+            album_ids = [row['album_id'] for row in await self.homework_table.get_homework(user_id)]
+            albums_hash = self.playlist_table.hash_albums(album_ids)
+            playlist = await self.playlist_table.get_playlist(user_id)
+            if playlist is not None and playlist['albums_hash'] == albums_hash:
+                return
+            # no point making a playlist for someone without any homework
+            if playlist is None and not album_ids:
+                return
+            if playlist is None:
+                name = await self.get_user_name(user_id)
+                playlist_id, url = await self.spotify.find_or_create_playlist(f"{name}'s Homework")
+                await self.playlist_table.save_playlist(user_id, playlist_id, url)
+            else:
+                playlist_id = playlist['playlist_id']
+            tracks = await self.spotify.get_album_track_uris(album_ids)
+            await self.spotify.sync_playlist(playlist_id, tracks)
+            await self.playlist_table.save_albums_hash(user_id, albums_hash)
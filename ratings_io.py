@@ -0,0 +1,112 @@
+import csv
+import re
+from io import StringIO
+from math import isfinite
+from json import loads, dumps, JSONDecodeError
+
+# reading and writing files of ratings for /import-ratings and /export-ratings.
+# a file is either csv (with a header row) or json (a list of objects, or one object per line),
+# and only needs album_id and rating, anything else (like the names /export-ratings writes) is ignored.
+# album_id can also be a spotify link or uri, since that's what people are going to have lying around
+
+# discord attachments can be way bigger than any ratings list, this is about 40k ratings worth of export
+MAX_IMPORT_BYTES = 2_000_000
+# how many bad rows we bother telling people about
+MAX_PROBLEMS_SHOWN = 5
+EXPORT_COLUMNS = ('album_id', 'artist', 'album_name', 'year', 'rating')
+# every rating has to be in here, whether it comes from a file or from /add-rating and /edit-rating
+MIN_RATING = 0.0
+MAX_RATING = 10.0
+# spotify ids are 22 base62 characters, optionally inside a link (open.spotify.com/album/<id>) or uri (spotify:album:<id>)
+ALBUM_ID_PATTERN = re.compile(r'(?:album[/:])?([0-9A-Za-z]{22})(?![0-9A-Za-z])')
+
+
+def album_id_from_entry(entry) -> str | None:
+    match = ALBUM_ID_PATTERN.search(str(entry).strip())
+    return match.group(1) if match else None
+
+
+# turns a rating into a float, raising ValueError if it isn't a number from MIN_RATING to MAX_RATING.
+# float() happily takes 'nan' and 'inf', and sqlite stores nan as NULL, which breaks that album's stats
+def check_rating(rating) -> float:
+    try:
+        rating = float(rating)
+    except (TypeError, ValueError):
+        raise ValueError(f"error: {rating!r} isn't a rating")
+    if not isfinite(rating) or not MIN_RATING <= rating <= MAX_RATING:
+        raise ValueError(f"error: ratings have to be from {MIN_RATING} to {MAX_RATING}, not {rating}")
+    return rating
+
+
+def is_json(text: str, filename: str) -> bool:
+    return filename.lower().endswith(('.json', '.jsonl')) or text.lstrip()[:1] in ('[', '{')
+
+
+# yields (line number, album_id entry, rating entry) for every row in the file, without checking them yet
+def read_rows(text: str, filename: str):
+    if not is_json(text, filename):
+        reader = csv.DictReader(StringIO(text))
+        if reader.fieldnames is None or not {'album_id', 'rating'} <= {name.strip().lower() for name in reader.fieldnames}:
+            raise ValueError("error: the csv needs a header row with (at least) album_id and rating columns")
+        for row in reader:
+            row = {key.strip().lower(): value for key, value in row.items() if key is not None}
+            yield reader.line_num, row.get('album_id'), row.get('rating')
+    elif text.lstrip().startswith('['):
+        for i, row in enumerate(loads(text)):
+            yield i + 1, *entry_from_object(row)
+    else:
+        for i, line in enumerate(text.splitlines()):
+            if line.strip():
+                yield i + 1, *entry_from_object(loads(line))
+
+
+def entry_from_object(row) -> tuple:
+    if not isinstance(row, dict):
+        return None, None
+    return row.get('album_id'), row.get('rating')
+
+
+# turns the file into {album_id: rating} (if an album is in there twice, the last rating wins),
+# and a list of what was wrong with the rows that got skipped
+def parse_ratings(text: str, filename: str) -> tuple[dict, list[str]]:
+    ratings = {}
+    problems = []
+    try:
+        for line, entry, rating in read_rows(text, filename):
+            album_id = album_id_from_entry(entry) if entry is not None else None
+            if album_id is None:
+                problems.append(f"row {line}: couldn't find a spotify album id in {entry!r}")
+                continue
+            try:
+                ratings[album_id] = check_rating(rating)
+            except ValueError as error:
+                problems.append(f"row {line}: {str(error).removeprefix('error: ')}")
+    except (JSONDecodeError, csv.Error) as error:
+        raise ValueError(f"error: couldn't read {filename} ({error})")
+    return ratings, problems
+
+
+def format_problems(problems: list[str]) -> str:
+    if not problems:
+        return ''
+    shown = '\n'.join(problems[:MAX_PROBLEMS_SHOWN])
+    more = f"\n...and {len(problems) - MAX_PROBLEMS_SHOWN} more" if len(problems) > MAX_PROBLEMS_SHOWN else ''
+    return f"\nskipped {len(problems)} rows:\n{shown}{more}"
+
+
+# writes rows (an async iterator of rating rows joined with master_table) into a csv/json file as they come in
+async def write_ratings(rows, json_format: bool = False) -> bytes:
+    output = StringIO()
+    if json_format:
+        output.write('[')
+        separator = '\n'
+        async for row in rows:
+            output.write(separator + dumps({column: row[column] for column in EXPORT_COLUMNS}))
+            separator = ',\n'
+        output.write('\n]\n')
+    else:
+        writer = csv.writer(output)
+        writer.writerow(EXPORT_COLUMNS)
+        async for row in rows:
+            writer.writerow((row['album_id'], ', '.join(row['artist']), row['album_name'], row['year'], row['rating']))
+    return output.getvalue().encode()
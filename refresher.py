@@ -0,0 +1,38 @@
+import asyncio
+from dataclasses import dataclass, field
+from time import monotonic
+from traceback import print_exc
+from typing import Callable
+
+# redraws the rankings boards in the background so commands don't have to wait on discord.
+# commands just mark a year as dirty once their database write is committed, and the refresher redraws that year
+# once nobody has touched it for `debounce` seconds. a burst of ratings in the same year turns into one redraw,
+# and there is only ever one redraw running per year (changes made during a redraw get picked up by another one after)
+
+
+@dataclass
+class RankingsRefresher:
+    # async function that redraws a single year's board (display_rankings in main)
+    render: Callable
+    debounce: float = 2.0
+    dirty: set[int] = field(default_factory=set)
+    last_request: dict[int, float] = field(default_factory=dict)
+    tasks: dict[int, asyncio.Task] = field(default_factory=dict)
+
+    def request(self, year: int):
+        self.dirty.add(year)
+        self.last_request[year] = monotonic()
+        task = self.tasks.get(year)
+        if task is None or task.done():
+            self.tasks[year] = asyncio.create_task(self._refresh(year))
+
+    async def _refresh(self, year: int):
+        while year in self.dirty:
+            # keep waiting until the year has been quiet for a whole debounce window
+            while (wait := self.last_request[year] + self.debounce - monotonic()) > 0:
+                await asyncio.sleep(wait)
+            self.dirty.discard(year)
+            try:
+                await self.render(year)
+            except Exception:
+                print_exc()
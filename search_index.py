@@ -0,0 +1,148 @@
+from bisect import bisect_left, insort
+from collections import Counter
+from itertools import islice
+
+# an in-memory search index so autocomplete doesn't have to read (and scan) all of master_table on every keystroke.
+# a query matches an entry when every word of the query is part of some word in the entry's text,
+# e.g. "rad ok" matches "Radiohead - OK Computer".
+#
+# the index maps every distinct word to the entries containing it, and every 3 letter chunk (trigram) to the words
+# containing it. a query word is looked up through its trigrams instead of checking every word we know about
+# (query words shorter than 3 letters can't use trigrams, so those check every word).
+# the words containing recent query words are remembered and kept up to date as words come and go,
+# since autocomplete asks about the same few words over and over while someone is typing
+
+GRAM = 3
+MAX_REMEMBERED_PARTS = 4096
+TRANSLATE_TABLE = str.maketrans('', '', '\'",-.!/():')
+
+
+def tokenize(text: str) -> list[str]:
+    return text.lower().translate(TRANSLATE_TABLE).split()
+
+
+def grams(word: str) -> set[str]:
+    return {word[i:i + GRAM] for i in range(len(word) - GRAM + 1)}
+
+
+# words are indexed with spaces around them, so the start and end of a word get trigrams of their own
+# ("  r", " ra" and "ad " for "radiohead"). that makes typo matching favour words that start the same way
+def padded_grams(word: str) -> set[str]:
+    return grams(f'  {word} ')
+
+
+class SearchIndex:
+    def __init__(self):
+        self.texts = {}
+        self.words_by_key = {}
+        self.keys_by_word = {}
+        self.words_by_gram = {}
+        self.words_by_part = {}
+        # every word, in alphabetical order, for finding the words that start with something
+        self.sorted_words = []
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __contains__(self, key):
+        return key in self.texts
+
+    def add(self, key, text: str):
+        if key in self.texts:
+            self.remove(key)
+        self.texts[key] = text
+        self.words_by_key[key] = words = frozenset(tokenize(text))
+        for word in words:
+            keys = self.keys_by_word.get(word)
+            if keys is None:
+                keys = self.keys_by_word[word] = set()
+                self._add_word(word)
+            keys.add(key)
+
+    def remove(self, key):
+        if self.texts.pop(key, None) is None:
+            return
+        for word in self.words_by_key.pop(key):
+            keys = self.keys_by_word[word]
+            keys.discard(key)
+            if not keys:
+                del self.keys_by_word[word]
+                self._remove_word(word)
+
+    def clear(self):
+        self.__init__()
+
+    def _add_word(self, word: str):
+        insort(self.sorted_words, word)
+        for gram in padded_grams(word):
+            self.words_by_gram.setdefault(gram, set()).add(word)
+        for part, words in self.words_by_part.items():
+            if part in word:
+                words.add(word)
+
+    def _remove_word(self, word: str):
+        del self.sorted_words[bisect_left(self.sorted_words, word)]
+        for gram in padded_grams(word):
+            words = self.words_by_gram[gram]
+            words.discard(word)
+            if not words:
+                del self.words_by_gram[gram]
+        for words in self.words_by_part.values():
+            words.discard(word)
+
+    # every word in the index that has part somewhere inside it
+    def words_containing(self, part: str) -> set[str]:
+        words = self.words_by_part.get(part)
+        if words is not None:
+            return words
+        if len(part) < GRAM:
+            words = {word for word in self.keys_by_word if part in word}
+        else:
+            # start from the rarest trigram so the sets being intersected stay small
+            postings = sorted((self.words_by_gram.get(gram, set()) for gram in grams(part)), key=len)
+            words = {word for word in postings[0].intersection(*postings[1:]) if part in word}
+        if len(self.words_by_part) >= MAX_REMEMBERED_PARTS:
+            del self.words_by_part[next(iter(self.words_by_part))]
+        self.words_by_part[part] = words
+        return words
+
+    def words_starting_with(self, prefix: str):
+        for word in islice(self.sorted_words, bisect_left(self.sorted_words, prefix), None):
+            if not word.startswith(prefix):
+                return
+            yield word
+
+    # words sharing enough trigrams with part to probably be the same word with a typo or two,
+    # mapped to how similar they are (dice coefficient of their trigrams, 1.0 is identical)
+    def similar_words(self, part: str, threshold: float = 0.4) -> dict[str, float]:
+        part_grams = padded_grams(part)
+        shared = Counter()
+        for gram in part_grams:
+            shared.update(self.words_by_gram.get(gram, ()))
+        similar = {}
+        for word, count in shared.items():
+            # a padded word has len(word) + 1 trigrams (give or take repeats)
+            similarity = 2 * count / (len(part_grams) + len(word) + 1)
+            if similarity >= threshold:
+                similar[word] = similarity
+        return similar
+
+    # up to limit keys of entries matching query.
+    # instead of working out every match, this goes through the entries of the query word that matches the fewest
+    # words and checks the other query words against each one, stopping as soon as it has enough
+    def search(self, query: str, limit: int = 25) -> list:
+        parts = set(tokenize(query))
+        if not parts:
+            return list(islice(self.texts, limit))
+        word_sets = sorted((self.words_containing(part) for part in parts), key=len)
+        found = {}
+        for word in word_sets[0]:
+            for key in self.keys_by_word[word]:
+                if key in found:
+                    continue
+                key_words = self.words_by_key[key]
+                if all(not words.isdisjoint(key_words) for words in word_sets[1:]):
+                    found[key] = None
+                    if len(found) >= limit:
+                        return list(found)
+        return list(found)
@@ -1,6 +1,21 @@
 import spotify.sync as spotify
 from spotify import errors as spotify_errors
+from asyncio import Semaphore, ensure_future, gather, get_running_loop, shield
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from functools import partial
+from cache import LRUCache, SQLiteCache
+
+# spotify.sync blocks whatever thread calls it until spotify answers, so every public method here is async
+# and does the blocking part on a small thread pool. that way the discord event loop keeps running
+# (heartbeats, autocomplete, other peoples commands) while we wait on spotify
+
+# how many results we ask spotify for when searching (also the most autocomplete can show)
+SEARCH_LIMIT = 25
+# spotify's get several albums endpoint takes at most 20 ids per request
+ALBUM_BATCH_SIZE = 20
+# and the playlist endpoints take/give at most 100 tracks per request
+PLAYLIST_BATCH_SIZE = 100
 
 
 @dataclass
@@ -8,21 +23,54 @@ class Spotify:
     client_id: str
     client_secret: str
     client_refresh: str
+    cache_path: str = 'rankings.db'
+    max_workers: int = 4
+    # how many album batches can be fetched at once, kept below max_workers so searches still get a thread
+    max_album_batches: int = 2
 
     def __post_init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='spotify')
+        self.album_batch_limit = Semaphore(self.max_album_batches)
         self.spotify_client = spotify.Client(self.client_id, self.client_secret)
         self.spotify_user = spotify.User.from_refresh_token(self.spotify_client, self.client_refresh)
 
+        # album lookups go memory -> sqlite -> spotify, album metadata basically never changes
+        self.album_memory = LRUCache(maxsize=512)
+        self.album_store = SQLiteCache(self.cache_path, 'album_cache')
+        # same for the track uris of each album (only needed for homework playlists)
+        self.track_memory = LRUCache(maxsize=512)
+        self.track_store = SQLiteCache(self.cache_path, 'album_tracks_cache')
+
+        # autocomplete searches on every keystroke, so results are cached by normalized query for a bit,
+        # and searches that are already running are shared instead of being sent to spotify again
+        self.search_cache = LRUCache(maxsize=1024, ttl=60 * 10)
+        self.searches_in_flight = {}
+
+    # runs a blocking function on the spotify thread pool and waits for it without blocking the event loop
+    async def _run(self, func, *args, **kwargs):
+        return await get_running_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+
     # uses an id to find an album, and if no id is given, searches for the top result in spotify
     # returns tuple (artist, album, id, release date, image url)
-    def get_album(self, artist_name: tuple = None, album_name=None, album_id=None) -> spotify.Album:
+    async def get_album(self, artist_name: tuple = None, album_name=None, album_id=None) -> spotify.Album:
+        # albums we've looked up recently don't need to leave the event loop at all
+        if album_id is not None:
+            album = self.album_memory.get(album_id)
+            if album is not None:
+                return album
+        return await self._run(self._get_album, artist_name, album_name, album_id)
+
+    def _get_album(self, artist_name: tuple = None, album_name=None, album_id=None) -> spotify.Album:
         if artist_name is None and album_name is None and album_id is None:
             raise ValueError("error: no artist, album, or id was entered")
         elif album_id is not None:
-            try:
-                album = (self.spotify_client.get_album(spotify_id=album_id))
-            except spotify_errors.HTTPException:
-                raise ValueError("error: an invalid id was entered. (hint: select an autocomplete option)")
+            album = self.get_cached_album(album_id)
+            if album is None:
+                try:
+                    album = (self.spotify_client.get_album(spotify_id=album_id))
+                except spotify_errors.HTTPException:
+                    raise ValueError("error: an invalid id was entered. (hint: select an autocomplete option)")
+                self.cache_album(album)
         else:
             artists = " ".join(artist_name)
             results = self.spotify_client.search(f"{album_name} {artists}", types=["album"], limit=1)
@@ -31,46 +79,222 @@ class Spotify:
             album = results[2][0]
         return album
 
+    # gets a bunch of albums at once. cached albums are used as is,
+    # everything else is fetched from spotify 20 at a time with a couple of batches running at once
+    async def get_albums(self, album_ids) -> list[spotify.Album]:
+        albums = []
+        missing = []
+        for album_id in album_ids:
+            album = self.album_memory.get(album_id)
+            if album is None:
+                missing.append(album_id)
+            else:
+                albums.append(album)
+
+        async def fetch_batch(batch):
+            async with self.album_batch_limit:
+                return await self._run(self._get_albums, batch)
+
+        batches = [missing[i:i + ALBUM_BATCH_SIZE] for i in range(0, len(missing), ALBUM_BATCH_SIZE)]
+        for fetched in await gather(*[fetch_batch(batch) for batch in batches]):
+            albums.extend(fetched)
+        return albums
+
+    def _get_albums(self, album_ids: list) -> list[spotify.Album]:
+        albums = []
+        to_fetch = []
+        for album_id in album_ids:
+            album = self.get_cached_album(album_id)
+            if album is None:
+                to_fetch.append(album_id)
+            else:
+                albums.append(album)
+        if not to_fetch:
+            return albums
+
+        try:
+            fetched = self.spotify_client.get_albums(*to_fetch)
+        except (spotify_errors.HTTPException, AttributeError, TypeError):
+            # spotify rejects the whole batch (or gives back nulls) if any id is bad,
+            # so fall back to asking one at a time and skipping the bad ones
+            fetched = []
+            for album_id in to_fetch:
+                try:
+                    fetched.append(self.spotify_client.get_album(spotify_id=album_id))
+                except spotify_errors.HTTPException:
+                    print(f'skipping invalid album id {album_id}')
+        for album in fetched:
+            self.cache_album(album)
+        return albums + fetched
+
+    # returns the album if we've seen it recently, without going to spotify. returns None otherwise
+    def get_cached_album(self, album_id) -> spotify.Album | None:
+        album = self.album_memory.get(album_id)
+        if album is not None:
+            return album
+        data = self.album_store.get(album_id)
+        if data is None:
+            return None
+        album = spotify.Album(self.spotify_client, data)
+        self.album_memory.put(album_id, album)
+        return album
+
+    def cache_album(self, album: spotify.Album):
+        self.album_memory.put(album.id, album)
+        self.album_store.put(album.id, album_to_dict(album))
+
     async def search_album(self, search_str: str):
-        results = self.spotify_client.search(f"{search_str}", types=["album"], limit=25)
+        query = normalize_query(search_str)
+        if not query:
+            return tuple()
+        results = self.search_cache.get(query)
+        if results is not None:
+            return results
+
+        results = self._search_album_from_prefix(query)
+        if results is not None:
+            self.search_cache.put(query, results)
+            return results
+
+        # if someone else is already searching for this exact thing, wait on their search instead.
+        # shield means one autocomplete getting cancelled (because the user kept typing) doesn't cancel it for everyone
+        search = self.searches_in_flight.get(query)
+        if search is None:
+            search = ensure_future(self._run(self._search_album, query))
+            self.searches_in_flight[query] = search
+            search.add_done_callback(lambda _: self.searches_in_flight.pop(query, None))
+        results = await shield(search)
+        self.search_cache.put(query, results)
+        return results
+
+    # if we already searched a shorter version of this query and spotify gave back less than a full page,
+    # then that was everything it had, so we can just filter those results instead of searching again
+    def _search_album_from_prefix(self, query: str):
+        for end in range(len(query) - 1, 0, -1):
+            results = self.search_cache.get(query[:end])
+            if results is None:
+                continue
+            if len(results) >= SEARCH_LIMIT:
+                return None
+            words = query.split(' ')
+            return tuple(album for album in results
+                         if all(word in normalize_query(f"{album.name} {' '.join(artist.name for artist in album.artists)}")
+                                for word in words))
+        return None
+
+    def _search_album(self, search_str: str):
+        results = self.spotify_client.search(f"{search_str}", types=["album"], limit=SEARCH_LIMIT)
         return tuple(results[2])
 
-    def get_playlist(self, user):
-        playlist_name = f"{user.display_name}'s Homework"
+    # PLAYLIST SECTION
+    # everyone's homework gets mirrored into a playlist on the bot's spotify account (see playlists.py for when).
+    # the playlist calls go straight to spotify's web api through the user's http client instead of through
+    # spotify.py's Playlist objects, which only ever read the first page of tracks and add them one request at a time
 
-        playlist = None
-        for pl in self.spotify_user.get_playlists():
-            if pl.name == playlist_name:
-                playlist = pl
-                break
+    # runs one of the user http client's coroutines on spotify.py's own event loop thread and waits for the result
+    def _user_request(self, coro):
+        return self.spotify_client.__client_thread__.run_coroutine_threadsafe(coro)
 
+    # finds the bot's playlist called name (for playlists made before their ids were saved), or makes a new one.
+    # returns (playlist id, playlist url)
+    async def find_or_create_playlist(self, name: str) -> tuple[str, str]:
+        return await self._run(self._find_or_create_playlist, name)
+
+    def _find_or_create_playlist(self, name: str) -> tuple[str, str]:
+        playlist = next((pl for pl in self.spotify_user.get_all_playlists() if pl.name == name), None)
         if playlist is None:
-            playlist = self.spotify_user.create_playlist(playlist_name,
-                                                         description="Your homework, managed by the Ranking Bot")
-        return playlist
-
-    def add_album_to_playlist(self, user, album_id):
-        playlist = self.get_playlist(user)
-        album = self.spotify_client.get_album(album_id)
-        tracks = album.get_all_tracks()
-
-        playlist_tracks = playlist.get_tracks()
-        for track in tracks:
-            exists = False
-            for existing in playlist_tracks:
-                if existing.id == track.id:
-                    exists = True
-                    break
-            if exists:
-                continue
-            playlist.add_tracks(track)
+            playlist = self.spotify_user.create_playlist(name, description="Your homework, managed by the Ranking Bot")
+        return playlist.id, playlist.url
+
+    # uris of every track on each album, in album order. an album's tracks never change,
+    # so they're cached like albums are (memory, then rankings.db)
+    async def get_album_track_uris(self, album_ids) -> list[str]:
+        uris = []
+        for album_id in album_ids:
+            album_uris = self.track_memory.get(album_id)
+            if album_uris is None:
+                album_uris = await self._run(self._get_album_track_uris, album_id)
+            uris.extend(album_uris)
+        return uris
+
+    def _get_album_track_uris(self, album_id) -> list[str]:
+        uris = self.track_store.get(album_id)
+        if uris is None:
+            album = self.get_cached_album(album_id) or self.spotify_client.get_album(album_id)
+            uris = [track.uri for track in album.get_all_tracks()]
+            self.track_store.put(album_id, uris)
+        self.track_memory.put(album_id, uris)
+        return uris
+
+    async def get_playlist_track_uris(self, playlist_id: str) -> list[str]:
+        return await self._run(self._get_playlist_track_uris, playlist_id)
+
+    def _get_playlist_track_uris(self, playlist_id: str) -> list[str]:
+        uris = []
+        while True:
+            data = self._user_request(self.spotify_user.http.get_playlist_tracks(
+                playlist_id, fields='items(track(uri)),total', limit=PLAYLIST_BATCH_SIZE, offset=len(uris)))
+            uris.extend(item['track']['uri'] for item in data['items'] if item.get('track'))
+            if not data['items'] or len(uris) >= data['total']:
+                return uris
 
-    def remove_album_from_playlist(self, user, album_id):
-        playlist = self.get_playlist(user)
-        album = self.spotify_client.get_album(album_id)
-        tracks = album.get_all_tracks()
-        for track in tracks:
-            playlist.remove_tracks(track)
+    # makes the playlist hold exactly tracks (a list of uris), only sending what's different,
+    # 100 tracks per request (the most spotify takes). new tracks go on the end in the order given.
+    # returns (number added, number removed)
+    async def sync_playlist(self, playlist_id: str, tracks: list[str]) -> tuple[int, int]:
+        return await self._run(self._sync_playlist, playlist_id, tracks)
+
+    def _sync_playlist(self, playlist_id: str, tracks: list[str]) -> tuple[int, int]:
+        current = set(self._get_playlist_track_uris(playlist_id))
+        wanted = set(tracks)
+        to_add = [uri for uri in dict.fromkeys(tracks) if uri not in current]
+        to_remove = [uri for uri in current if uri not in wanted]
+        for i in range(0, len(to_remove), PLAYLIST_BATCH_SIZE):
+            self._remove_playlist_tracks(playlist_id, to_remove[i:i + PLAYLIST_BATCH_SIZE])
+        for i in range(0, len(to_add), PLAYLIST_BATCH_SIZE):
+            self._user_request(self.spotify_user.http.add_playlist_tracks(
+                playlist_id, tracks=to_add[i:i + PLAYLIST_BATCH_SIZE]))
+        return len(to_add), len(to_remove)
+
+    # spotify.py's own remove_playlist_tracks builds its route as "DELETE " (with a space),
+    # which aiohttp refuses to send, so the same request gets made here with the method spelled right
+    def _remove_playlist_tracks(self, playlist_id: str, uris: list[str]):
+        http = self.spotify_user.http
+        route = http.route("DELETE", "/playlists/{playlist_id}/tracks", playlist_id=playlist_id)
+        self._user_request(http.request(route, json={"tracks": [{"uri": uri} for uri in uris]}))
 
     def close_spotify_conn(self):
+        self.executor.shutdown(wait=True)
         self.spotify_client.close()
+        self.album_store.close()
+        self.track_store.close()
+
+
+# the year an album came out. spotify only gives "1997" or "1997-05" for some (older) albums,
+# so this reads the year straight off the front instead of parsing the whole date
+def release_year(album: spotify.Album) -> int:
+    return int(album.release_date[:4])
+
+
+# lowercases and collapses whitespace so "Radiohead  OK" and "radiohead ok" share a cache entry
+def normalize_query(search_str: str) -> str:
+    return ' '.join(search_str.lower().split())
+
+
+# spotify.Album doesn't keep the json it was made from, so this rebuilds enough of it
+# that spotify.Album(client, data) gives back an equivalent album (used for the album cache)
+def album_to_dict(album: spotify.Album) -> dict:
+    return {
+        'id': album.id,
+        'name': album.name,
+        'href': album.href,
+        'uri': album.uri,
+        'external_urls': {'spotify': album.url},
+        'album_type': album.type,
+        'release_date': album.release_date,
+        'release_date_precision': album.release_date_precision,
+        'total_tracks': album.total_tracks,
+        'images': [{'height': image.height, 'width': image.width, 'url': image.url} for image in album.images],
+        'artists': [{'id': artist.id, 'name': artist.name, 'href': artist.href, 'uri': artist.uri,
+                     'external_urls': {'spotify': artist.url}} for artist in album.artists]
+    }
@@ -1,60 +1,264 @@
+import asyncio
+import re
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from collections import Counter
+from hashlib import sha256
 from itertools import repeat
+from json import loads
+from threading import local, Lock
+from time import time_ns
 from spotify import Album
 from datetime import datetime
-from spotify_integration import Spotify
+from spotify_integration import Spotify, release_year
+import migrations
+from cache import LRUCache
+from search_index import SearchIndex
+
+
+# owns every connection to the database file, and makes sure none of the sqlite work happens on the event loop.
+# all writes go through one writer thread (sqlite only allows one writer at a time anyway),
+# and reads go to a small pool of threads that each have their own read-only connection.
+# since the database is in WAL mode, reads don't have to wait for writes to finish.
+#
+# statements run outside of a transaction commit straight away (reads never commit, there's nothing to commit).
+# statements inside `async with db.transaction():` run on the writer connection (reads too, so they see what the
+# transaction has done so far) and only get committed once the whole block finishes, or rolled back if it raises.
+# a transaction holds the write lock, so writes from other commands wait until it's done instead of joining it.
+# transactions can be nested, the inner ones just join the outer one.
+# every transaction gets an id that sql on the writer connection can read with transaction_id() (NULL outside of one),
+# which is how the event log knows which changes were made together
+class Database:
+    def __init__(self, path: str, readers: int = 3, make_rows=None):
+        self.path = path
+        # called once per query with (cursor.description, rows), see make_rows at the bottom of this file
+        self.make_rows = make_rows
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-reader')
+        self._write_conn = self._writer.submit(self._connect, False).result()
+        self._write_lock = asyncio.Lock()
+        self._in_transaction = ContextVar('in_transaction', default=False)
+        self._after_commit = ContextVar('after_commit', default=None)
+        self._local = local()
+        self._reader_conns = []
+        self._reader_conns_lock = Lock()
+        # goes up every time a write is committed, so anything built from the database can tell if it's out of date
+        self.version = 0
+        self.transaction_id = None
+
+    def _connect(self, read_only: bool):
+        if read_only:
+            conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.create_function('transaction_id', 0, lambda: self.transaction_id)
+        migrations.configure_connection(conn, read_only=read_only)
+        return conn
+
+    # each reader thread opens its own connection the first time it's used
+    def _reader_conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect(True)
+            with self._reader_conns_lock:
+                self._reader_conns.append(conn)
+        return conn
+
+    def _execute(self, conn: sqlite3.Connection, query, params, many: bool = False):
+        cursor = conn.cursor()
+        try:
+            if many:
+                cursor.executemany(query, params)
+            else:
+                cursor.execute(query, params)
+            rows = cursor.fetchall()
+            if self.make_rows is None or cursor.description is None:
+                return rows
+            return self.make_rows(cursor.description, rows)
+        finally:
+            cursor.close()
+
+    # runs on the writer thread. commits unless we're inside a transaction() block
+    def _write(self, query, params, many: bool, commit: bool):
+        try:
+            data = self._execute(self._write_conn, query, params, many)
+        except BaseException:
+            if commit and self._write_conn.in_transaction:
+                self._write_conn.rollback()
+            raise
+        if commit and self._write_conn.in_transaction:
+            self._write_conn.commit()
+        if commit:
+            self.version += 1
+        return data
+
+    def _read(self, query, params):
+        return self._execute(self._reader_conn(), query, params)
+
+    async def _run(self, executor, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+    @staticmethod
+    def is_read(query: str) -> bool:
+        return query.lstrip().upper().startswith('SELECT')
+
+    async def execute(self, query, params: tuple = tuple()):
+        if self._in_transaction.get():
+            return await self._run(self._writer, self._write, query, params, False, False)
+        if self.is_read(query):
+            return await self._run(self._readers, self._read, query, params)
+        async with self._write_lock:
+            return await self._run(self._writer, self._write, query, params, False, True)
+
+    async def executemany(self, query, rows: list):
+        if self._in_transaction.get():
+            return await self._run(self._writer, self._write, query, rows, True, False)
+        async with self._write_lock:
+            return await self._run(self._writer, self._write, query, rows, True, True)
+
+    @asynccontextmanager
+    async def transaction(self):
+        if self._in_transaction.get():
+            yield self
+            return
+        async with self._write_lock:
+            token = self._in_transaction.set(True)
+            callbacks_token = self._after_commit.set([])
+            # nanoseconds since the epoch, so ids are unique across restarts too
+            self.transaction_id = time_ns()
+            try:
+                await self._run(self._writer, self._write_conn.execute, 'BEGIN')
+                try:
+                    yield self
+                except BaseException:
+                    await self._run(self._writer, self._write_conn.rollback)
+                    raise
+                await self._run(self._writer, self._write_conn.commit)
+                self.version += 1
+                for callback in self._after_commit.get():
+                    callback()
+            finally:
+                self.transaction_id = None
+                self._after_commit.reset(callbacks_token)
+                self._in_transaction.reset(token)
+
+    @property
+    def in_transaction(self) -> bool:
+        return self._in_transaction.get()
+
+    # runs callback once whatever was just written is committed. outside of a transaction that's straight away,
+    # inside one it's when the transaction commits (and never, if it gets rolled back)
+    def after_commit(self, callback):
+        callbacks = self._after_commit.get()
+        if callbacks is None:
+            callback()
+        else:
+            callbacks.append(callback)
+
+    # for startup only (creating tables, migrations), before the event loop is running.
+    # runs on the writer thread and blocks until it's done
+    def execute_blocking(self, query, params: tuple = tuple()):
+        return self._writer.submit(self._write, query, params, False, True).result()
+
+    def run_blocking(self, func):
+        return self._writer.submit(func, self._write_conn).result()
+
+    def close(self):
+        def close_writer(conn):
+            conn.commit()
+            conn.execute('PRAGMA optimize')
+            conn.close()
+        self.run_blocking(close_writer)
+        self._writer.shutdown()
+        self._readers.shutdown()
+        for conn in self._reader_conns:
+            conn.close()
 
 
 class BaseTable:
 
     def __init__(self,
-                 conn: sqlite3.Connection,
+                 db: Database,
                  spotify: Spotify,
                  name: str,
                  cols: tuple,
                  col_types: tuple,
                  primary_key: str = None,
                  create_table_appendix: str = ' '):
-        self.conn = conn
+        self.db = db
         self.spotify = spotify
         self.cols = cols
         self.col_types = col_types
         self.name = name
         self.primary_key = primary_key
+        JSON_COLUMNS.update(col for col, col_type in zip(cols, col_types) if col_type.startswith('JSON'))
         self.create_table(create_table_appendix)
 
-    def __call__(self, query, input_row: tuple = tuple(), error_handle_graceful: bool = False):
-        cursor = self.conn.cursor()
+    async def __call__(self, query, input_row: tuple = tuple(), error_handle_graceful: bool = False):
         try:
-            cursor.execute(query, input_row)
+            return await self.db.execute(query, input_row)
         except sqlite3.Error as error:
             if error_handle_graceful:
                 print('ignoring exception\nquery: ' + query + '\nparams:' + str(input_row) + '\nerror: ' + str(error))
-            else:
-                print('query: ' + query + '\nparams:' + str(input_row) + '\nerror: ' + str(error))
-                raise error
-        data = cursor.fetchall()
-        cursor.close()
-        self.conn.commit()
-        return data
+                return []
+            print('query: ' + query + '\nparams:' + str(input_row) + '\nerror: ' + str(error))
+            raise error
 
-    def executemany(self, query, input_rows: list):
-        cursor = self.conn.cursor()
+    async def executemany(self, query, input_rows: list):
         try:
-            cursor.executemany(query, input_rows)
+            return await self.db.executemany(query, input_rows)
         except sqlite3.Error as error:
             raise ValueError('error: could not properly select from table\nquery:', query, '\nerror:', str(error))
-        data = cursor.fetchall()
-        cursor.close()
-        self.conn.commit()
-        return data
+
+    # USER CACHE SECTION
+    # autocomplete asks for the same user's rows on every keystroke, so tables can keep them around per user.
+    # entries are keyed by the user's generation, which invalidate_user() bumps whenever that user's rows change,
+    # so a read that was already running when the change happened can't put old rows back into the cache
+    def setup_user_cache(self, maxsize: int = 128):
+        self.user_cache = LRUCache(maxsize=maxsize)
+        self.user_generations = Counter()
+        self.user_cache_epoch = 0
+
+    async def cached_for_user(self, user_id, key, query, params: tuple):
+        # inside a transaction we'd be reading rows that aren't committed yet (and might get rolled back)
+        if self.db.in_transaction:
+            return await self(query, params)
+        cache_key = (self.user_cache_epoch, user_id, self.user_generations[user_id], key)
+        rows = self.user_cache.get(cache_key)
+        if rows is None:
+            rows = await self(query, params)
+            self.user_cache.put(cache_key, rows)
+        return rows
+
+    # called by the write methods, from inside a transaction. it runs once now (so nothing reads the rows we're about
+    # to change into the cache) and again once the transaction commits (in case something read them while it was open).
+    # outside of a transaction the second bump would happen before the write is committed, so writes open one even
+    # for a single statement
+    def invalidate_user(self, user_id):
+        def bump():
+            self.user_generations[user_id] += 1
+        bump()
+        self.db.after_commit(bump)
+
+    # for when rows change for lots of users at once (like update_master_table)
+    def clear_user_cache(self):
+        self.user_cache_epoch += 1
+        self.user_cache.clear()
+
+    # every table shares the same database, so a transaction started from any table covers all of them
+    # usage: async with rating_table.transaction(): ...
+    def transaction(self):
+        return self.db.transaction()
 
     def create_table(self, appendix=' '):
         cols = tuple(f'{col} {col_type}' for col, col_type in zip(self.cols, self.col_types))
         query = f'''CREATE TABLE IF NOT EXISTS {self.name} ({', '.join(cols) + appendix})'''
-        return self(query)
+        return self.db.execute_blocking(query)
 
-    def insert_single_row(self, row: tuple, appendix=' '):
+    async def insert_single_row(self, row: tuple, appendix=' '):
         if len(row) != len(self.cols):
             raise ValueError('error, invalid row')
 
@@ -62,9 +266,9 @@ class BaseTable:
         query = f'''
         INSERT INTO {self.name} {self.cols}
         VALUES ({', '.join(repeat('?', len(self.cols)))}) RETURNING *''' + appendix
-        return self(query, row)
+        return await self(query, row)
 
-    def insert_multiple_rows(self, rows: list):
+    async def insert_multiple_rows(self, rows: list):
         # checking each row to make sure they are all proper length
         if not all([len(row) == len(self.cols) for row in rows]):
             raise ValueError('error, invalid row included')
@@ -73,13 +277,25 @@ class BaseTable:
         query = f'''
         INSERT INTO {self.name} {self.cols} 
         VALUES ({', '.join(repeat('?', len(self.cols)))}) RETURNING *'''
-        return self.executemany(query, rows)
+        return await self.executemany(query, rows)
 
-    def get_full_table(self):
-        return self(f'''SELECT * FROM {self.name}''')
+    async def get_full_table(self):
+        return await self(f'''SELECT * FROM {self.name}''')
 
-    def get_ids(self):
-        return {album['album_id'] for album in self(f'''SELECT album_id FROM {self.name}''')}
+    # master_table only holds albums that someone has rated or has as homework.
+    # albums get added to master_table (with their spotify info) right before their first rating/homework row,
+    # and this trigger removes them as soon as their last rating/homework row is deleted,
+    # so we don't have to diff every table after every command (update_master_table is just a repair job now)
+    def create_orphan_trigger(self):
+        return self.db.execute_blocking(f'''CREATE TRIGGER IF NOT EXISTS {self.name}_remove_orphans AFTER DELETE ON {self.name}
+        BEGIN
+            DELETE FROM master_table WHERE album_id = OLD.album_id
+            AND NOT EXISTS (SELECT 1 FROM rating_table WHERE album_id = OLD.album_id)
+            AND NOT EXISTS (SELECT 1 FROM homework_table WHERE album_id = OLD.album_id);
+        END''')
+
+    async def get_ids(self):
+        return {album['album_id'] for album in await self(f'''SELECT album_id FROM {self.name}''')}
 
 
 # ALBUM_MASTER TABLE INTERACTIONS SECTION------------------------------------------------------------------------------
@@ -87,12 +303,20 @@ class BaseTable:
 # it stores properly formatted artist name (0), album name (1), the spotify album id (2),
 # the release year (3) and a hyperlink to the cover image (4)
 class MasterTable(BaseTable):
-    def __init__(self, conn: sqlite3.Connection, spotify: Spotify):
+    def __init__(self, db: Database, spotify: Spotify):
         cols = ('album_id', 'album_name', 'artist', 'year', 'album_cover_url')
         col_types = ('VARCHAR(25) PRIMARY KEY', 'VARCHAR(255)', 'JSON', 'INTEGER', 'VARCHAR(255)')
-        super().__init__(conn, spotify, 'master_table', cols, col_types, primary_key='album_id')
-
-    def insert_single_row(self, row: tuple, appendix=' '):
+        super().__init__(db, spotify, 'master_table', cols, col_types, primary_key='album_id')
+        # in-memory search indexes for autocomplete (see search_index.py and ranked_search in autocomplete.py),
+        # filled by load_index() on startup and kept up to date by add_row/remove_row.
+        # album_index maps album_id -> "artist - album name", artist_index maps each "artist, artist" string -> itself
+        # (artist_albums counts the albums using it) and indexed_albums maps album_id -> (album name, artist string)
+        self.album_index = SearchIndex()
+        self.artist_index = SearchIndex()
+        self.artist_albums = Counter()
+        self.indexed_albums = {}
+
+    async def insert_single_row(self, row: tuple, appendix=' '):
         if len(row) != len(self.cols):
             raise ValueError('error, invalid row')
 
@@ -100,116 +324,324 @@ class MasterTable(BaseTable):
         query = f'''
         INSERT OR IGNORE INTO {self.name} {self.cols}
         VALUES ({', '.join(repeat('?', len(self.cols)))}) RETURNING *''' + appendix
-        return self(query, row)
+        return await self(query, row)
 
-    def add_row(self, album: Album):
+    async def add_row(self, album: Album):
+        # in this case where we are adding rows that may cause a primary key conflict, we can ignore primary key errors
+        row = self.album_to_row(album)
+        await self.insert_single_row(row)
+        # only once it's committed, so a rolled back transaction doesn't leave the album in autocomplete
+        self.db.after_commit(lambda: self.index_album(row[0], row[1], row[2]))
+
+    # same as add_row but for a bunch of albums at once (one executemany instead of a query per album)
+    async def add_rows(self, albums: list[Album]):
+        rows = [self.album_to_row(album) for album in albums]
+        await self.executemany(f'''INSERT OR IGNORE INTO {self.name} {self.cols}
+        VALUES ({', '.join(repeat('?', len(self.cols)))})''', rows)
+
+        def index_rows():
+            for row in rows:
+                self.index_album(row[0], row[1], row[2])
+        self.db.after_commit(index_rows)
+
+    # turns a spotify album into a row for this table
+    @staticmethod
+    def album_to_row(album: Album):
         album_id = album.id
         album_name = album.name
         artist_names = [artist.name for artist in album.artists]
-        year = datetime.fromisoformat(album.release_date).year
+        year = release_year(album)
         album_cover_url = next(iter(album.images)).url
+        return album_id, album_name, artist_names, year, album_cover_url
 
-        # in this case where we are adding rows that may cause a primary key conflict, we can ignore primary key errors
-        self.insert_single_row((album_id, album_name, artist_names, year, album_cover_url))
-
-    def get_row(self, album_id):
-        return self(f'''SELECT * FROM {self.name} WHERE album_id = ?''', tuple([album_id]))
+    async def get_row(self, album_id):
+        return await self(f'''SELECT * FROM {self.name} WHERE album_id = ?''', tuple([album_id]))
 
-    def remove_row(self, album_id):
-        return self(f'''DELETE FROM {self.name} WHERE album_id = ? RETURNING *''', tuple([album_id]))
+    async def remove_row(self, album_id):
+        data = await self(f'''DELETE FROM {self.name} WHERE album_id = ? RETURNING *''', tuple([album_id]))
+        self.db.after_commit(lambda: self.unindex_album(album_id))
+        return data
 
-    # this function is called via command and should refresh the master list
+    # SEARCH INDEX SECTION
+    def index_album(self, album_id, album_name, artists):
+        self.unindex_album(album_id)
+        artist = ", ".join(artists)
+        self.indexed_albums[album_id] = (album_name, artist)
+        self.album_index.add(album_id, f'{artist} - {album_name}')
+        self.artist_albums[artist] += 1
+        self.artist_index.add(artist, artist)
+
+    def unindex_album(self, album_id):
+        if album_id not in self.indexed_albums:
+            return
+        album_name, artist = self.indexed_albums.pop(album_id)
+        self.album_index.remove(album_id)
+        self.artist_albums[artist] -= 1
+        if self.artist_albums[artist] <= 0:
+            del self.artist_albums[artist]
+            self.artist_index.remove(artist)
+
+    async def load_index(self):
+        self.album_index.clear()
+        self.artist_index.clear()
+        self.artist_albums.clear()
+        self.indexed_albums.clear()
+        for row in await self(f'''SELECT album_id, album_name, artist FROM {self.name}'''):
+            self.index_album(row['album_id'], row['album_name'], row['artist'])
+
+    # full text search over album names and artists, using the master_search fts5 table (migration 2).
+    # every word of query has to match the start of a word in the album name or artists, best matches (bm25) first
+    async def search(self, query: str, limit: int = 25):
+        match = fts_query(query)
+        if not match:
+            return []
+        return await self(f'''SELECT album_id, {self.name}.album_name, {self.name}.artist, year FROM master_search
+        INNER JOIN {self.name} ON {self.name}.rowid = master_search.rowid
+        WHERE master_search MATCH ? ORDER BY bm25(master_search) LIMIT ?''', (match, limit))
+
+    # rebuilds master_search from master_table, in case it's ever out of sync
+    async def rebuild_search(self):
+        await self('''INSERT INTO master_search (master_search) VALUES ('rebuild')''')
+
+    # the orphan trigger can delete albums without going through remove_row,
+    # so anything that deletes ratings/homework should call this with the album ids afterwards
+    async def prune_index(self, *album_ids):
+        album_ids = [album_id for album_id in album_ids if album_id in self.indexed_albums]
+        if not album_ids:
+            return
+        rows = await self(f'''SELECT album_id FROM {self.name} WHERE album_id IN ({', '.join(repeat('?', len(album_ids)))})''',
+                          tuple(album_ids))
+        for album_id in set(album_ids) - {row['album_id'] for row in rows}:
+            self.unindex_album(album_id)
+
+    # this rebuilds the master list from scratch. the triggers keep it up to date normally,
+    # so this only needs to run to repair it (/update and /sync)
     async def update_master_table(self, rating_table, homework_table):
-        master_ids = self.get_ids()
-        user_album_ids = rating_table.get_ids()
-        homework_album_ids = homework_table.get_ids()
+        master_ids = await self.get_ids()
+        user_album_ids = await rating_table.get_ids()
+        homework_album_ids = await homework_table.get_ids()
 
         # finding albums in master but aren't in other tables
-        master_v_user_uniques = master_ids - user_album_ids
-        master_v_homework_uniques = master_ids - homework_album_ids
-        master_only_differences = master_v_homework_uniques & master_v_user_uniques
-        for album_id in master_only_differences:
-            self.remove_row(album_id)
+        remove_from_master = master_ids - user_album_ids - homework_album_ids
 
         # finding albums in user_album or homework but not in master
+        # (fetched before we start writing so the transaction isn't held open while we wait on spotify)
         add_to_master = (user_album_ids | homework_album_ids) - master_ids
-        for album_id in add_to_master:
-            album = self.spotify.get_album(album_id=album_id)
-            self.add_row(album)
+        albums = await self.spotify.get_albums(add_to_master) if add_to_master else []
+
+        # all the deletes and inserts go in one transaction
+        async with self.transaction():
+            await self.executemany(f'''DELETE FROM {self.name} WHERE album_id = ?''',
+                                   [(album_id,) for album_id in remove_from_master])
+            await self.executemany(f'''INSERT OR IGNORE INTO {self.name} {self.cols}
+            VALUES ({', '.join(repeat('?', len(self.cols)))})''', [self.album_to_row(album) for album in albums])
+        # this is the repair job, so fix up the search indexes from scratch too
+        await self.rebuild_search()
+        await self.load_index()
 
 
 class RatingTable(BaseTable):
-    def __init__(self, conn: sqlite3.Connection, spotify: Spotify):
+    def __init__(self, db: Database, spotify: Spotify):
         cols = ('album_id', 'user_id', 'rating')
         col_types = ('VARCHAR(25)', 'INTEGER', 'FLOAT')
         appendix = (', FOREIGN KEY (album_id) REFERENCES master_table(album_id) '
                     'PRIMARY KEY (album_id, user_id)')
-        super().__init__(conn, spotify, 'rating_table', cols, col_types,
+        super().__init__(db, spotify, 'rating_table', cols, col_types,
                          primary_key='album_id', create_table_appendix=appendix)
+        self.create_orphan_trigger()
+        self.setup_user_cache()
 
-    def get_full_table(self):
-        return self(f'''SELECT * FROM {self.name} INNER JOIN master_table USING(album_id)''')
+    async def get_full_table(self):
+        return await self(f'''SELECT * FROM {self.name} INNER JOIN master_table USING(album_id)''')
 
-    def get_users_ratings(self, user_id: int):
-        return self(f'''SELECT * FROM {self.name} INNER JOIN master_table USING(album_id)
-                    WHERE user_id = ? ORDER BY rating DESC''', tuple([user_id]))
+    # cached per user, since the /edit-rating and /remove-rating autocompletes ask for this on every keystroke
+    async def get_users_ratings(self, user_id: int):
+        return await self.cached_for_user(user_id, 'ratings', f'''SELECT * FROM {self.name}
+                    INNER JOIN master_table USING(album_id) WHERE user_id = ? ORDER BY rating DESC''', tuple([user_id]))
 
-    def get_single_album_ratings(self, album_id):
-        return self(f'''SELECT rating FROM {self.name} WHERE album_id = ?''', tuple([album_id]))
-
-    def get_users(self):
-        user_rows = self(f'''SELECT DISTINCT user_id FROM {self.name}''')
+    async def get_users(self):
+        user_rows = await self(f'''SELECT DISTINCT user_id FROM {self.name}''')
         return [row['user_id'] for row in user_rows]
 
-    def get_grouped_ratings(self):
-        # group concatenates all the ratings together with commas so i can split later
-        data = self(f'''SELECT GROUP_CONCAT(rating) AS ratings, artist, album_name, album_id, year FROM {self.name} 
-        INNER JOIN master_table USING (album_id) GROUP BY album_id''')
+    # every rating from a year (-1 for every year), grouped by user with each user's highest ratings first
+    async def get_year_ratings(self, year: int = datetime.now().year):
+        where = 'WHERE year = ?' if year != -1 else ''
+        return await self(f'''SELECT user_id, album_name, artist, rating FROM {self.name}
+        INNER JOIN master_table USING(album_id) {where} ORDER BY user_id, rating DESC''',
+                          (year,) if year != -1 else ())
 
-        # splits ratings into lists for each album
-        for album in data:
-            # needs each rating (separated by commas) to be a float, so cast using map
-            album['ratings'] = list(map(float, album['ratings'].split(',')))
-        return data
-
-    # transforms rows into nice looking string
-    def get_user_ratings_formatted(self, user_id, year=datetime.now().year):
-        rows = [row for row in self.get_users_ratings(user_id) if int(row['year']) == int(year) or int(year) == -1]
-        rankings_str = ''
-        for i, row in enumerate(rows):
-            ranking_str = f'{i + 1}. ' + ", ".join(row['artist']) + f" - {row['album_name']} ({row['rating']})"
-            rankings_str += ranking_str + '\n'
-        return rankings_str
-
-    def get_single_rating(self, user_id, album_id):
-        return self(f'''SELECT * FROM {self.name} INNER JOIN master_table USING (album_id) 
+    async def get_single_rating(self, user_id, album_id):
+        return await self(f'''SELECT * FROM {self.name} INNER JOIN master_table USING (album_id) 
         WHERE user_id = ? AND album_id = ? ''',
-                    (user_id, album_id))
-
-    def add_row(self, album_id: str, user_id: int, rating: float):
-        return self.insert_single_row((album_id, user_id, rating))
-
-    def edit_row(self, album_id: str, user_id: int, new_rating: float):
-        return self(f'''UPDATE {self.name} SET rating = ? WHERE user_id = ? AND album_id = ? 
-        RETURNING *''', (new_rating, user_id, album_id))
-
-    def remove_row(self, album_id: str, user_id: int):
-        return self(f'''DELETE FROM {self.name} WHERE album_id = ? AND user_id = ? 
-        RETURNING *''', (album_id, user_id))
+                          (user_id, album_id))
+
+    async def add_row(self, album_id: str, user_id: int, rating: float):
+        async with self.transaction():
+            self.invalidate_user(user_id)
+            return await self.insert_single_row((album_id, user_id, rating))
+
+    async def edit_row(self, album_id: str, user_id: int, new_rating: float):
+        async with self.transaction():
+            self.invalidate_user(user_id)
+            return await self(f'''UPDATE {self.name} SET rating = ? WHERE user_id = ? AND album_id = ? 
+            RETURNING *''', (new_rating, user_id, album_id))
+
+    async def remove_row(self, album_id: str, user_id: int):
+        async with self.transaction():
+            self.invalidate_user(user_id)
+            return await self(f'''DELETE FROM {self.name} WHERE album_id = ? AND user_id = ? 
+            RETURNING *''', (album_id, user_id))
+
+    # adds a bunch of ratings ({album_id: rating}) for one user, all in one transaction.
+    # albums the user already rated are left alone unless overwrite is set.
+    # the albums have to be in master_table already. returns (number added, number changed)
+    async def add_rows(self, user_id: int, ratings: dict, overwrite: bool = False):
+        async with self.transaction():
+            self.invalidate_user(user_id)
+            existing = {row['album_id']: row['rating'] for row in
+                        await self(f'''SELECT album_id, rating FROM {self.name} WHERE user_id = ?''', (user_id,))}
+            added = [(album_id, user_id, rating) for album_id, rating in ratings.items() if album_id not in existing]
+            changed = [(rating, user_id, album_id) for album_id, rating in ratings.items()
+                       if overwrite and album_id in existing and existing[album_id] != rating]
+            await self.executemany(f'''INSERT INTO {self.name} {self.cols} VALUES (?, ?, ?)''', added)
+            await self.executemany(f'''UPDATE {self.name} SET rating = ? WHERE user_id = ? AND album_id = ?''',
+                                   changed)
+        return len(added), len(changed)
+
+    # every one of a user's ratings (with the album info), a page at a time so the whole list is never in memory.
+    # pages are keyed by album_id, so it keeps working even if ratings get added while it's going
+    async def iter_users_ratings(self, user_id: int, page_size: int = 500):
+        last_album_id = ''
+        while True:
+            page = await self(f'''SELECT album_id, album_name, artist, year, rating FROM {self.name}
+            INNER JOIN master_table USING (album_id) WHERE user_id = ? AND album_id > ?
+            ORDER BY album_id LIMIT ?''', (user_id, last_album_id, page_size))
+            for row in page:
+                yield row
+            if len(page) < page_size:
+                return
+            last_album_id = page[-1]['album_id']
+
+
+# ALBUM_STATS TABLE SECTION---------------------------------------------------------------------------------------------
+# album_stats keeps the number of ratings, mean and M2 (sum of squared differences from the mean) of every rated album.
+# triggers on rating_table update it with welford's running moments inside the same transaction as the rating change,
+# so stats and leaderboards never have to look at rating_table. if it ever drifts, rebuild() recomputes it from scratch
+class AlbumStatsTable(BaseTable):
+    def __init__(self, db: Database, spotify: Spotify):
+        cols = ('album_id', 'num_ratings', 'mean', 'm2')
+        col_types = ('VARCHAR(25) PRIMARY KEY', 'INTEGER', 'FLOAT', 'FLOAT')
+        super().__init__(db, spotify, 'album_stats', cols, col_types, primary_key='album_id')
+        self.create_triggers()
+
+    def create_triggers(self):
+        # adding x: mean += (x - mean) / (n + 1), m2 += (x - mean)^2 * n / (n + 1)
+        self.db.execute_blocking(f'''CREATE TRIGGER IF NOT EXISTS {self.name}_add AFTER INSERT ON rating_table
+        BEGIN
+            INSERT INTO {self.name} (album_id, num_ratings, mean, m2) VALUES (NEW.album_id, 1, NEW.rating, 0)
+            ON CONFLICT (album_id) DO UPDATE SET
+            num_ratings = num_ratings + 1,
+            mean = mean + (NEW.rating - mean) / (num_ratings + 1.0),
+            m2 = m2 + (NEW.rating - mean) * (NEW.rating - mean) * num_ratings / (num_ratings + 1.0);
+        END''')
+        # changing x to y: mean += (y - x) / n, m2 += (y - x) * (y - new mean + x - old mean)
+        self.db.execute_blocking(f'''CREATE TRIGGER IF NOT EXISTS {self.name}_edit AFTER UPDATE OF rating ON rating_table
+        BEGIN
+            UPDATE {self.name} SET
+            mean = mean + (NEW.rating - OLD.rating) / num_ratings,
+            m2 = MAX(m2 + (NEW.rating - OLD.rating)
+                     * (NEW.rating - (mean + (NEW.rating - OLD.rating) / num_ratings) + OLD.rating - mean), 0)
+            WHERE album_id = NEW.album_id;
+        END''')
+        # removing x: mean = (n * mean - x) / (n - 1), m2 -= (x - mean)^2 * n / (n - 1)
+        self.db.execute_blocking(f'''CREATE TRIGGER IF NOT EXISTS {self.name}_remove AFTER DELETE ON rating_table
+        BEGIN
+            DELETE FROM {self.name} WHERE album_id = OLD.album_id AND num_ratings <= 1;
+            UPDATE {self.name} SET
+            num_ratings = num_ratings - 1,
+            mean = (num_ratings * mean - OLD.rating) / (num_ratings - 1.0),
+            m2 = MAX(m2 - (OLD.rating - mean) * (OLD.rating - mean) * num_ratings / (num_ratings - 1.0), 0)
+            WHERE album_id = OLD.album_id;
+        END''')
+
+    # recomputes every album's stats from rating_table (two passes, so it doesn't have any of the drift)
+    async def rebuild(self):
+        async with self.transaction():
+            await self(f'''DELETE FROM {self.name}''')
+            await self._recompute('')
+            await self._save_checkpoint()
+        return (await self(f'''SELECT COUNT(*) AS num_albums FROM {self.name}'''))[0]['num_albums']
+
+    # recomputes only the albums that have had ratings change since the last rebuild/repair (see event_log),
+    # so startup doesn't have to go through every rating. falls back to a full rebuild if there's no checkpoint yet.
+    # returns how many albums got recomputed
+    async def repair(self):
+        async with self.transaction():
+            checkpoint = await self(f'''SELECT event_id FROM event_checkpoints WHERE name = ?''', (self.name,))
+            if not checkpoint:
+                return await self.rebuild()
+            changed = f'''SELECT DISTINCT album_id FROM event_log
+            WHERE event_id > {int(checkpoint[0]['event_id'])} AND action LIKE 'rating%' '''
+            num_albums = (await self(f'''SELECT COUNT(*) AS num_albums FROM ({changed})'''))[0]['num_albums']
+            await self(f'''DELETE FROM {self.name} WHERE album_id IN ({changed})''')
+            await self._recompute(f'WHERE album_id IN ({changed})')
+            await self._save_checkpoint()
+        return num_albums
+
+    async def _recompute(self, where: str):
+        await self(f'''INSERT INTO {self.name} (album_id, num_ratings, mean, m2)
+        SELECT album_id, COUNT(rating), averages.mean, SUM((rating - averages.mean) * (rating - averages.mean))
+        FROM rating_table INNER JOIN (SELECT album_id, AVG(rating) AS mean FROM rating_table {where} GROUP BY album_id)
+        AS averages USING (album_id) GROUP BY album_id''')
+
+    async def _save_checkpoint(self):
+        await self(f'''INSERT OR REPLACE INTO event_checkpoints (name, event_id)
+        SELECT ?, COALESCE(MAX(event_id), 0) FROM event_log''', (self.name,))
+
+    # count, mean and sample variance of every rated album. year=-1 means every year.
+    # sort_by 'avg' sorts highest mean first, anything else sorts lowest variance first. limit=-1 means no limit
+    async def get_album_aggregates(self, year: int = -1, min_ratings: int = 1, sort_by: str = 'avg', limit: int = -1):
+        where = 'AND year = ?' if year != -1 else ''
+        order = 'mean DESC' if 'avg' in sort_by else 'variance ASC'
+        params = (min_ratings,) + ((year,) if year != -1 else ()) + (limit,)
+        return await self(f'''SELECT album_id, album_name, artist, year, {STATS_COLUMNS}
+        FROM {self.name} INNER JOIN master_table USING (album_id)
+        WHERE num_ratings >= ? {where} ORDER BY {order} LIMIT ?''', params)
+
+    # same as above, but for one album. returns None if nobody has rated it
+    async def get_album_aggregate(self, album_id):
+        data = await self(f'''SELECT album_id, {STATS_COLUMNS} FROM {self.name} WHERE album_id = ?''', (album_id,))
+        return next(iter(data), None)
+
+    # how many ratings each album in a year has, most ratings first (used for the top albums autocomplete)
+    async def get_rating_counts(self, year: int = -1):
+        where = 'WHERE year = ?' if year != -1 else ''
+        data = await self(f'''SELECT num_ratings FROM {self.name} INNER JOIN master_table USING (album_id)
+        {where} ORDER BY num_ratings DESC''', (year,) if year != -1 else ())
+        return [row['num_ratings'] for row in data]
+
+
+# sample variance = m2 / (n - 1), which is NULL for albums with one rating (division by zero).
+# sqlite doesn't always come with sqrt, so the standard deviation is worked out in python from this
+STATS_COLUMNS = '''num_ratings, mean, m2 / (num_ratings - 1) AS variance'''
 
 
 class HomeworkTable(BaseTable):
-    def __init__(self, conn: sqlite3.Connection, spotify: Spotify):
+    def __init__(self, db: Database, spotify: Spotify):
         name = 'homework_table'
         cols = ('album_id', 'user_id', 'complete')
         col_types = ('VARCHAR(25)', 'INTEGER', 'BIT')
         appendix = ', PRIMARY KEY (album_id, user_id)'
-        super().__init__(conn, spotify, name, cols, col_types, create_table_appendix=appendix)
+        super().__init__(db, spotify, name, cols, col_types, create_table_appendix=appendix)
+        self.create_orphan_trigger()
+        self.setup_user_cache()
 
-    def add_homework(self, user_id, album_id):
+    async def add_homework(self, user_id, album_id):
         try:
-            data = self(f'''INSERT INTO {self.name} (album_id, user_id, complete) VALUES (?, ?, 0) RETURNING *''',
-                        (album_id, user_id))
+            async with self.transaction():
+                self.invalidate_user(user_id)
+                data = await self(f'''INSERT INTO {self.name} (album_id, user_id, complete) VALUES (?, ?, 0)
+                RETURNING *''', (album_id, user_id))
         except sqlite3.Error as error:
             if error.sqlite_errorcode is sqlite3.SQLITE_CONSTRAINT_PRIMARYKEY:
                 raise ValueError("error: you cannot add duplicate entries into your homework list")
@@ -217,35 +649,246 @@ class HomeworkTable(BaseTable):
                 raise error
         return f"successfully added {len(data)} row to homework"
 
-    # returns a specific users homework
-    def get_homework(self, user_id, complete=0):
-        return self(f'''SELECT * FROM {self.name}
+    # gives everyone who has rated anything the album as homework in one statement,
+    # skipping people who already rated it or already have it. returns the ids of the users it was added for
+    async def add_homework_for_everyone(self, album_id):
+        async with self.transaction():
+            data = await self(f'''INSERT OR IGNORE INTO {self.name} (album_id, user_id, complete)
+            SELECT DISTINCT ?, user_id, 0 FROM rating_table
+            WHERE user_id NOT IN (SELECT user_id FROM rating_table WHERE album_id = ?)
+            RETURNING user_id''', (album_id, album_id))
+            user_ids = [row['user_id'] for row in data]
+            for user_id in user_ids:
+                self.invalidate_user(user_id)
+        return user_ids
+
+    # returns a specific users homework (cached per user, the /remove-homework autocomplete asks on every keystroke)
+    async def get_homework(self, user_id, complete=0):
+        return await self.cached_for_user(user_id, complete, f'''SELECT * FROM {self.name}
                        INNER JOIN master_table USING(album_id)
                        WHERE user_id = ? AND complete = ?''', (user_id, complete))
 
-    def get_all_homework_rows(self, complete=0):
-        return self(f'''SELECT * FROM {self.name}
+    # everyone who has any homework
+    async def get_users(self):
+        return [row['user_id'] for row in await self(f'''SELECT DISTINCT user_id FROM {self.name}''')]
+
+    async def get_all_homework_rows(self, complete=0):
+        return await self(f'''SELECT * FROM {self.name}
                        INNER JOIN master_table ON homework.album_id = album_master.id
                        WHERE complete = ?''', (complete,))
 
-    def remove_homework(self, user_id, album_id):
-        data = self(f'''DELETE FROM {self.name} WHERE album_id = ? AND user_id = ? RETURNING *''',
-             (album_id, user_id))
+    async def remove_homework(self, user_id, album_id):
+        async with self.transaction():
+            self.invalidate_user(user_id)
+            data = await self(f'''DELETE FROM {self.name} WHERE album_id = ? AND user_id = ? RETURNING *''',
+                 (album_id, user_id))
         if data is None:
             raise ValueError("error: row not found in your homework")
         return f"successfully deleted {len(data)} rows from homework"
 
-    def get_homework_formatted(self, user, complete=0):
-        data = self.get_homework(user.id, complete)
+    # removes a bunch of albums from a user's homework (they don't all have to be there)
+    async def remove_many(self, user_id, album_ids: list):
+        async with self.transaction():
+            self.invalidate_user(user_id)
+            await self.executemany(f'''DELETE FROM {self.name} WHERE album_id = ? AND user_id = ?''',
+                                   [(album_id, user_id) for album_id in album_ids])
+
+    async def get_homework_formatted(self, user, complete=0):
+        data = await self.get_homework(user.id, complete)
         output = f'## Homework of {user.mention}\n'
         for i, row in enumerate(data):
             output += f"{i + 1}. " + ", ".join(row['artist']) + f" - {row['album_name']} ({row['year']})\n"
         if len(data) == 0:
             output += f"{user.display_name} doesn't have any homework at the moment\n"
-        return output + f"\nPlaylist URL: {self.spotify.get_playlist(user).url}"
+        # the playlist is made/updated in the background (see playlists.py), so this just shows it once it exists
+        playlist = await self(f'''SELECT url FROM playlist_table WHERE user_id = ?''', (user.id,))
+        if playlist:
+            output += f"\nPlaylist URL: {playlist[0]['url']}"
+        return output
+
+
+# EVENT LOG SECTION-----------------------------------------------------------------------------------------------------
+# an append only history of every rating/homework change (what /history shows and /undo works from).
+# triggers on rating_table and homework_table write it, so an event is committed in the same transaction as the change
+# itself (and rolled back with it), and nothing can change a rating without it showing up here.
+# user_id is whose list changed, old_value/new_value are the ratings before/after (NULL when there isn't one).
+# transaction_id is the same for every change made in one transaction (like /add-rating taking the album off your
+# homework), so those get undone together. undoing an event marks it as undone and logs the opposite change
+# with undo_of pointing back at it
+EVENT_ACTIONS = ('rating_add', 'rating_edit', 'rating_remove', 'homework_add', 'homework_remove')
+
+
+class EventLogTable(BaseTable):
+    def __init__(self, db: Database, spotify: Spotify):
+        cols = ('event_id', 'time', 'user_id', 'album_id', 'action', 'old_value', 'new_value', 'transaction_id',
+                'undo_of', 'undone')
+        col_types = ('INTEGER PRIMARY KEY', "INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))", 'INTEGER',
+                     'VARCHAR(25)', 'VARCHAR(16)', 'FLOAT', 'FLOAT', 'INTEGER', 'INTEGER', 'BIT DEFAULT 0')
+        super().__init__(db, spotify, 'event_log', cols, col_types, primary_key='event_id')
+        # how far through the log things built from it (like album_stats) are known to be up to date
+        self.db.execute_blocking('''CREATE TABLE IF NOT EXISTS event_checkpoints
+        (name VARCHAR(32) PRIMARY KEY, event_id INTEGER)''')
+        self.create_triggers()
+
+    def create_triggers(self):
+        triggers = (
+            ('rating_add', 'INSERT', 'rating_table', 'NEW', 'NULL', 'NEW.rating'),
+            ('rating_edit', 'UPDATE OF rating', 'rating_table', 'NEW', 'OLD.rating', 'NEW.rating'),
+            ('rating_remove', 'DELETE', 'rating_table', 'OLD', 'OLD.rating', 'NULL'),
+            ('homework_add', 'INSERT', 'homework_table', 'NEW', 'NULL', 'NULL'),
+            ('homework_remove', 'DELETE', 'homework_table', 'OLD', 'NULL', 'NULL'),
+        )
+        for action, event, table, row, old_value, new_value in triggers:
+            # editing a rating to what it already was isn't worth remembering
+            when = 'WHEN OLD.rating IS NOT NEW.rating' if action == 'rating_edit' else ''
+            self.db.execute_blocking(f'''CREATE TRIGGER IF NOT EXISTS {self.name}_{action} AFTER {event} ON {table}
+            {when}
+            BEGIN
+                INSERT INTO {self.name} (user_id, album_id, action, old_value, new_value, transaction_id)
+                VALUES ({row}.user_id, {row}.album_id, '{action}', {old_value}, {new_value}, transaction_id());
+            END''')
+
+    # a page of events (newest first), optionally only ones for a single user.
+    # pages are keyed by event_id instead of OFFSET, so pass the last event_id of a page as before to get the next one.
+    # (event_ids only ever go up, so this is the same as going back in time)
+    async def get_events(self, user_id: int = None, before: int = None, limit: int = 10):
+        conditions, params = [], []
+        if user_id is not None:
+            conditions.append('user_id = ?')
+            params.append(user_id)
+        if before is not None:
+            conditions.append('event_id < ?')
+            params.append(before)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        return await self(f'''SELECT {self.name}.*, album_name, master_table.artist FROM {self.name}
+        LEFT JOIN master_table USING (album_id) {where} ORDER BY event_id DESC LIMIT ?''', tuple(params + [limit]))
+
+    # the newest event of a user's that can still be undone (undoes themselves can't, undo the original again instead)
+    async def get_last_undoable(self, user_id: int):
+        data = await self(f'''SELECT * FROM {self.name} WHERE user_id = ? AND undone = 0 AND undo_of IS NULL
+        ORDER BY event_id DESC LIMIT 1''', (user_id,))
+        return next(iter(data), None)
+
+    # run inside the same transaction as the opposite change, right after making it
+    async def mark_undone(self, event):
+        await self(f'''UPDATE {self.name} SET undone = 1 WHERE event_id = ?''', (event['event_id'],))
+        await self(f'''UPDATE {self.name} SET undo_of = ? WHERE event_id =
+        (SELECT MAX(event_id) FROM {self.name} WHERE user_id = ? AND album_id = ? AND event_id > ?)''',
+                   (event['event_id'], event['user_id'], event['album_id'], event['event_id']))
+
+    # the user's events made in the same transaction as event (just event if it wasn't in one), newest first
+    async def get_transaction_events(self, event):
+        if event['transaction_id'] is None:
+            return [event]
+        return await self(f'''SELECT * FROM {self.name} WHERE user_id = ? AND transaction_id = ? AND undone = 0
+        AND undo_of IS NULL ORDER BY event_id DESC''', (event['user_id'], event['transaction_id']))
+
+
+# PLAYLIST TABLE SECTION------------------------------------------------------------------------------------------------
+# which spotify playlist holds each user's homework, and a hash of the homework albums it was last synced with
+# (so a sync can tell nothing changed without asking spotify)
+class PlaylistTable(BaseTable):
+    def __init__(self, db: Database, spotify: Spotify):
+        cols = ('user_id', 'playlist_id', 'url', 'albums_hash')
+        col_types = ('INTEGER PRIMARY KEY', 'VARCHAR(25)', 'TEXT', 'VARCHAR(64)')
+        super().__init__(db, spotify, 'playlist_table', cols, col_types, primary_key='user_id')
+
+    @staticmethod
+    def hash_albums(album_ids) -> str:
+        return sha256('\n'.join(sorted(album_ids)).encode()).hexdigest()
+
+    async def get_playlist(self, user_id: int):
+        return next(iter(await self(f'''SELECT * FROM {self.name} WHERE user_id = ?''', (user_id,))), None)
+
+    async def save_playlist(self, user_id: int, playlist_id: str, url: str):
+        await self(f'''INSERT OR REPLACE INTO {self.name} {self.cols} VALUES (?, ?, ?, NULL)''',
+                   (user_id, playlist_id, url))
+
+    async def save_albums_hash(self, user_id: int, albums_hash: str):
+        await self(f'''UPDATE {self.name} SET albums_hash = ? WHERE user_id = ?''', (albums_hash, user_id))
+
+
+# BOARD TABLE SECTION---------------------------------------------------------------------------------------------------
+# remembers which bot messages make up each year's rankings board (in order), and a hash of what each one says.
+# display_rankings uses this to only edit the messages that changed instead of deleting and resending everything
+class BoardTable(BaseTable):
+    def __init__(self, db: Database, spotify: Spotify):
+        cols = ('year', 'position', 'channel_id', 'message_id', 'content_hash')
+        col_types = ('INTEGER', 'INTEGER', 'INTEGER', 'INTEGER', 'VARCHAR(64)')
+        appendix = ', PRIMARY KEY (year, position)'
+        super().__init__(db, spotify, 'board_messages', cols, col_types, create_table_appendix=appendix)
+
+    @staticmethod
+    def hash_content(content: str) -> str:
+        return sha256(content.encode()).hexdigest()
+
+    async def get_board(self, year: int):
+        return await self(f'''SELECT * FROM {self.name} WHERE year = ? ORDER BY position''', (year,))
+
+    # messages is a list of (message_id, content_hash) in the order they appear in the channel
+    async def save_board(self, year: int, channel_id: int, messages: list):
+        async with self.transaction():
+            await self(f'''DELETE FROM {self.name} WHERE year = ?''', (year,))
+            await self.executemany(f'''INSERT INTO {self.name} {self.cols} VALUES (?, ?, ?, ?, ?)''',
+                                   [(year, i, channel_id, message_id, content_hash)
+                                    for i, (message_id, content_hash) in enumerate(messages)])
+
+
+# rows come back as tuples that can also be read like dictionaries (row['album_name']).
+# the column names are only looked up once per query instead of once per row, and every query with the same columns
+# shares one Row class, so a row costs about as much memory as a plain tuple.
+# JSON columns (artist) are only decoded when they're actually read, since most queries never look at them.
+# decoded lists come back as tuples and are shared between rows, so they can't be changed by accident
+JSON_COLUMNS = set()
+
+
+class Row(tuple):
+    __slots__ = ()
+    _index: dict = {}
+    _json: frozenset = frozenset()
+
+    def __getitem__(self, key):
+        if not isinstance(key, str):
+            return tuple.__getitem__(self, key)
+        i = self._index[key]
+        value = tuple.__getitem__(self, i)
+        if i in self._json and isinstance(value, str):
+            return decode_json(value)
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self._index else default
+
+    def keys(self):
+        return self._index.keys()
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __repr__(self):
+        return 'Row(' + ', '.join(f'{key}={self[key]!r}' for key in self._index) + ')'
+
+
+@lru_cache(maxsize=256)
+def row_class(columns: tuple) -> type:
+    index = {column: i for i, column in enumerate(columns)}
+    json = frozenset(i for column, i in index.items() if column in JSON_COLUMNS)
+    return type('Row', (Row,), {'__slots__': (), '_index': index, '_json': json})
+
+
+@lru_cache(maxsize=4096)
+def decode_json(text: str):
+    value = loads(text)
+    return tuple(value) if isinstance(value, list) else value
+
+
+# this is for the database to turn the rows of a query into Rows
+def make_rows(description, rows: list) -> list:
+    cls = row_class(tuple(col[0] for col in description))
+    return list(map(cls, rows))
 
 
-# this is for sqlite3 connection to transform rows into dictionaries
-def dict_factory(cursor: sqlite3.Cursor, row):
-    cols = [col[0] for col in cursor.description]
-    return {key: value for key, value in zip(cols, row)}
+# turns what someone typed into an fts5 query where every word is a prefix search ("radio ok" -> "radio"* "ok"*).
+# each word is quoted so nothing the user types gets treated as fts5 syntax
+def fts_query(text: str) -> str:
+    return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', text.lower()))
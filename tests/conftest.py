@@ -0,0 +1,47 @@
+import sqlite3
+import sys
+from functools import partial
+from json import dumps
+from pathlib import Path
+from types import SimpleNamespace
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import migrations
+import tables
+
+# same adapters main.py registers, so JSON columns (like master_table.artist) can be written
+sqlite3.register_adapter(dict, partial(dumps, ensure_ascii=False))
+sqlite3.register_adapter(list, partial(dumps, ensure_ascii=False))
+
+
+# opens a fresh rankings.db with every table, the way main.py does (spotify is never called by these tables).
+# the database has to be opened inside the test's event loop, so this gives back a function to call from there
+@pytest.fixture
+def open_tables(tmp_path):
+    opened = []
+
+    def open_tables():
+        db = tables.Database(str(tmp_path / 'rankings.db'), make_rows=tables.make_rows)
+        opened.append(db)
+        ns = SimpleNamespace(db=db,
+                             master_table=tables.MasterTable(db, None),
+                             rating_table=tables.RatingTable(db, None),
+                             homework_table=tables.HomeworkTable(db, None),
+                             album_stats_table=tables.AlbumStatsTable(db, None),
+                             event_log_table=tables.EventLogTable(db, None))
+        db.run_blocking(migrations.migrate)
+        return ns
+
+    yield open_tables
+    for db in opened:
+        db.close()
+
+
+# something that looks enough like a spotify album for MasterTable.album_to_row
+@pytest.fixture
+def make_album():
+    def make_album(album_id: str, name: str = 'Album', artist: str = 'Artist', release_date: str = '2020-01-01'):
+        return SimpleNamespace(id=album_id, name=name, artists=[SimpleNamespace(name=artist)],
+                               release_date=release_date, images=[SimpleNamespace(url='https://example.com/cover')])
+    return make_album
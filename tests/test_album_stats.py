@@ -0,0 +1,68 @@
+import asyncio
+import random
+from math import sqrt
+from statistics import mean, stdev
+import pytest
+
+# album_stats is kept up to date by triggers on rating_table (welford's running mean and m2),
+# so after any mix of adds, edits and removes it should still agree with working the stats out from scratch
+
+
+async def check_stats(t, expected: dict):
+    for album_id, album_ratings in expected.items():
+        aggregate = await t.album_stats_table.get_album_aggregate(album_id)
+        if not album_ratings:
+            assert aggregate is None
+            continue
+        assert aggregate['num_ratings'] == len(album_ratings)
+        assert aggregate['mean'] == pytest.approx(mean(album_ratings.values()), abs=1e-9)
+        if len(album_ratings) > 1:
+            assert sqrt(max(aggregate['variance'], 0)) == pytest.approx(stdev(album_ratings.values()), abs=1e-6)
+
+
+def test_triggers_match_recomputed_stats(open_tables, make_album):
+    rng = random.Random(7)
+    album_ids = ['a', 'b', 'c']
+    # album_id -> {user_id: rating}, what rating_table should hold
+    expected = {album_id: {} for album_id in album_ids}
+
+    async def run():
+        t = open_tables()
+        await t.master_table.add_rows([make_album(album_id) for album_id in album_ids])
+        for step in range(300):
+            album_id = rng.choice(album_ids)
+            user_id = rng.randrange(12)
+            rating = round(rng.uniform(0, 10), rng.choice([0, 1, 2]))
+            album_ratings = expected[album_id]
+            if user_id not in album_ratings:
+                await t.rating_table.add_row(album_id, user_id, rating)
+                album_ratings[user_id] = rating
+            elif rng.random() < 0.5:
+                await t.rating_table.edit_row(album_id, user_id, rating)
+                album_ratings[user_id] = rating
+            else:
+                await t.rating_table.remove_row(album_id, user_id)
+                del album_ratings[user_id]
+                # the orphan trigger takes the album out of master_table with its last rating
+                if not album_ratings:
+                    await t.master_table.add_row(make_album(album_id))
+            if step % 25 == 0:
+                await check_stats(t, expected)
+        await check_stats(t, expected)
+
+        # and rebuild (what startup falls back to) lands on the same numbers
+        await t.album_stats_table.rebuild()
+        await check_stats(t, expected)
+    asyncio.run(run())
+
+
+def test_stats_of_one_album(open_tables, make_album):
+    async def run():
+        t = open_tables()
+        await t.master_table.add_row(make_album('a'))
+        for user_id, rating in enumerate([8.0, 9.0, 8.5, 8.5]):
+            await t.rating_table.add_row('a', user_id, rating)
+        await t.rating_table.edit_row('a', 0, 7.5)
+        await t.rating_table.remove_row('a', 1)
+        await check_stats(t, {'a': {0: 7.5, 2: 8.5, 3: 8.5}})
+    asyncio.run(run())
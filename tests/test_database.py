@@ -0,0 +1,109 @@
+import asyncio
+import pytest
+
+# Database: one writer connection, a pool of read only connections, and transactions on top of the writer
+
+
+def test_failed_transaction_rolls_everything_back(open_tables, make_album):
+    async def run():
+        t = open_tables()
+        await t.master_table.add_row(make_album('a', name='Kept'))
+        await t.rating_table.add_row('a', 1, 5.0)
+        version = t.db.version
+        with pytest.raises(RuntimeError):
+            async with t.db.transaction():
+                await t.master_table.add_row(make_album('b', name='Rolled Back'))
+                await t.rating_table.add_row('b', 1, 8.0)
+                await t.rating_table.edit_row('a', 1, 9.0)
+                await t.homework_table.add_homework(1, 'a')
+                raise RuntimeError
+        assert t.db.version == version
+        assert not t.db.in_transaction
+        assert await t.master_table.get_row('b') == []
+        assert [row['rating'] for row in await t.rating_table.get_single_rating(1, 'a')] == [5.0]
+        assert await t.homework_table.get_homework(1) == []
+        assert (await t.album_stats_table.get_album_aggregate('a'))['mean'] == 5.0
+        assert await t.album_stats_table.get_album_aggregate('b') is None
+        assert [event['action'] for event in await t.event_log_table.get_events(1)] == ['rating_add']
+        # the album index only hears about albums once they're committed
+        assert 'b' not in t.master_table.indexed_albums
+
+        # and the writer connection is fine to use afterwards
+        await t.rating_table.edit_row('a', 1, 6.0)
+        assert [row['rating'] for row in await t.rating_table.get_single_rating(1, 'a')] == [6.0]
+    asyncio.run(run())
+
+
+def test_failed_statement_outside_a_transaction_is_rolled_back(open_tables, make_album):
+    async def run():
+        t = open_tables()
+        await t.master_table.add_row(make_album('a'))
+        await t.rating_table.add_row('a', 1, 5.0)
+        with pytest.raises(Exception):
+            await t.rating_table.insert_multiple_rows([('a', 2, 4.0), ('a', 1, 3.0)])
+        assert [row['user_id'] for row in await t.rating_table(
+            'SELECT user_id FROM rating_table WHERE album_id = ?', ('a',))] == [1]
+    asyncio.run(run())
+
+
+def test_readers_only_see_committed_data(open_tables, make_album):
+    async def run():
+        t = open_tables()
+        await t.master_table.add_row(make_album('a'))
+        # a plain write commits straight away, so the read pool sees it on the next read
+        await t.rating_table.add_row('a', 1, 5.0)
+        assert len(await t.rating_table.get_single_rating(1, 'a')) == 1
+
+        written = asyncio.Event()
+        checked = asyncio.Event()
+
+        # started outside the transaction, so its reads go to the read pool instead of joining the transaction
+        async def reader():
+            await written.wait()
+            rows = await t.rating_table.get_single_rating(2, 'a')
+            checked.set()
+            return rows
+        read = asyncio.create_task(reader())
+
+        async with t.db.transaction():
+            await t.rating_table.add_row('a', 2, 7.0)
+            # the transaction sees its own write
+            assert len(await t.rating_table.get_single_rating(2, 'a')) == 1
+            written.set()
+            await checked.wait()
+        assert await read == []
+        assert len(await t.rating_table.get_single_rating(2, 'a')) == 1
+    asyncio.run(run())
+
+
+def test_writes_wait_for_an_open_transaction(open_tables, make_album):
+    async def run():
+        t = open_tables()
+        await t.master_table.add_rows([make_album('a'), make_album('b')])
+        started = asyncio.Event()
+        order = []
+
+        async def other_command():
+            await started.wait()
+            await t.rating_table.add_row('b', 2, 4.0)
+            order.append('other write')
+        other = asyncio.create_task(other_command())
+
+        async with t.db.transaction():
+            transaction_id = t.db.transaction_id
+            await t.rating_table.add_row('a', 1, 5.0)
+            started.set()
+            await asyncio.sleep(0.05)
+            # nested transactions join the outer one
+            async with t.db.transaction():
+                assert t.db.transaction_id == transaction_id
+                await t.rating_table.add_row('b', 1, 6.0)
+            order.append('transaction')
+        await other
+        assert order == ['transaction', 'other write']
+
+        events = {(event['user_id'], event['album_id']): event['transaction_id']
+                  for event in await t.event_log_table('SELECT * FROM event_log')}
+        assert events[(1, 'a')] == events[(1, 'b')] == transaction_id
+        assert events[(2, 'b')] != transaction_id
+    asyncio.run(run())
@@ -0,0 +1,64 @@
+import asyncio
+import re
+from types import SimpleNamespace
+from spotify.http import HTTPUserClient
+from spotify_integration import Spotify
+
+# runs Spotify.sync_playlist's requests through spotify.py's real HTTPUserClient methods,
+# only swapping out the part that talks to spotify, so a bad route (like "DELETE ") shows up here
+# instead of on the bot's account
+
+# what http allows in a method name (rfc 9110 token), aiohttp won't send anything else
+HTTP_TOKEN = re.compile(r"[!#$%&'*+\-.^_`|~0-9A-Za-z]+")
+
+
+class RecordingHTTPClient(HTTPUserClient):
+    def __init__(self, playlist_uris):
+        self.playlist_uris = playlist_uris
+        self.sent = []
+
+    async def request(self, route, **kwargs):
+        method, url = route
+        assert HTTP_TOKEN.fullmatch(method), f"{method!r} isn't a valid http method"
+        self.sent.append((method, url, kwargs))
+        if method == "GET":
+            offset = kwargs['params']['offset']
+            items = [{'track': {'uri': uri}} for uri in self.playlist_uris[offset:offset + kwargs['params']['limit']]]
+            return {'items': items, 'total': len(self.playlist_uris)}
+        return {'snapshot_id': 'snapshot'}
+
+
+def make_spotify(playlist_uris) -> tuple[Spotify, RecordingHTTPClient]:
+    http = RecordingHTTPClient(playlist_uris)
+    spotify = object.__new__(Spotify)
+    spotify.spotify_user = SimpleNamespace(http=http)
+    spotify.spotify_client = SimpleNamespace(__client_thread__=SimpleNamespace(run_coroutine_threadsafe=asyncio.run))
+    return spotify, http
+
+
+def uris(start, stop):
+    return [f"spotify:track:{i}" for i in range(start, stop)]
+
+
+def test_sync_sends_valid_requests():
+    spotify, http = make_spotify(uris(0, 150))
+    added, removed = spotify._sync_playlist('playlist', uris(120, 330))
+    assert (added, removed) == (180, 120)
+
+    methods = [method for method, url, kwargs in http.sent]
+    assert methods == ['GET', 'GET', 'DELETE', 'DELETE', 'POST', 'POST']
+    for method, url, kwargs in http.sent:
+        assert url == 'https://api.spotify.com/v1/playlists/playlist/tracks'
+
+    deletes = [kwargs['json']['tracks'] for method, url, kwargs in http.sent if method == 'DELETE']
+    assert [len(batch) for batch in deletes] == [100, 20]
+    assert sorted(track['uri'] for batch in deletes for track in batch) == sorted(uris(0, 120))
+
+    posts = [kwargs['json']['uris'] for method, url, kwargs in http.sent if method == 'POST']
+    assert [uri for batch in posts for uri in batch] == uris(150, 330)
+
+
+def test_sync_does_nothing_when_playlist_matches():
+    spotify, http = make_spotify(uris(0, 10))
+    assert spotify._sync_playlist('playlist', uris(0, 10)) == (0, 0)
+    assert [method for method, url, kwargs in http.sent] == ['GET']
@@ -0,0 +1,49 @@
+import asyncio
+import pytest
+import ratings_io
+
+ALBUM_IDS = [f"{i:022d}" for i in range(6)]
+
+
+def test_parse_ratings_skips_ratings_that_arent_0_to_10():
+    rows = [(ALBUM_IDS[0], '7.5'), (ALBUM_IDS[1], 'nan'), (ALBUM_IDS[2], 'inf'),
+            (ALBUM_IDS[3], '-inf'), (ALBUM_IDS[4], '11'), (ALBUM_IDS[5], '-0.5')]
+    text = 'album_id,rating\n' + ''.join(f'{album_id},{rating}\n' for album_id, rating in rows)
+    ratings, problems = ratings_io.parse_ratings(text, 'ratings.csv')
+    assert ratings == {ALBUM_IDS[0]: 7.5}
+    assert [problem.split(':')[0] for problem in problems] == ['row 3', 'row 4', 'row 5', 'row 6', 'row 7']
+
+
+def test_parse_ratings_json_keeps_the_ends_of_the_range():
+    text = f'[{{"album_id": "spotify:album:{ALBUM_IDS[0]}", "rating": 0}},' \
+           f' {{"album_id": "{ALBUM_IDS[1]}", "rating": 10}},' \
+           f' {{"album_id": "{ALBUM_IDS[2]}", "rating": "NaN"}}]'
+    ratings, problems = ratings_io.parse_ratings(text, 'ratings.json')
+    assert ratings == {ALBUM_IDS[0]: 0.0, ALBUM_IDS[1]: 10.0}
+    assert len(problems) == 1 and problems[0].startswith('row 3')
+
+
+def test_check_rating_accepts_numbers_in_range():
+    assert ratings_io.check_rating('4.25') == 4.25
+
+
+@pytest.mark.parametrize('rating', ['nan', float('nan'), 'inf', 10.01, -1, None, 'good'])
+def test_check_rating_rejects(rating):
+    with pytest.raises(ValueError):
+        ratings_io.check_rating(rating)
+
+
+# whatever /export-ratings writes, /import-ratings has to be able to read back
+@pytest.mark.parametrize('json_format', [False, True])
+def test_export_can_be_imported(json_format):
+    rows = [{'album_id': ALBUM_IDS[0], 'artist': ('Sigur Rós', 'Jónsi'), 'album_name': 'Takk, "live"', 'year': 2005,
+             'rating': 9.5},
+            {'album_id': ALBUM_IDS[1], 'artist': ('Radiohead',), 'album_name': 'Kid A', 'year': 2000, 'rating': 0.0}]
+
+    async def iter_rows():
+        for row in rows:
+            yield row
+    exported = asyncio.run(ratings_io.write_ratings(iter_rows(), json_format)).decode()
+    ratings, problems = ratings_io.parse_ratings(exported, 'ratings.json' if json_format else 'ratings.csv')
+    assert ratings == {ALBUM_IDS[0]: 9.5, ALBUM_IDS[1]: 0.0}
+    assert problems == []
@@ -0,0 +1,88 @@
+import asyncio
+import migrations
+from autocomplete import ranked_search
+from search_index import SearchIndex
+
+# the in-memory indexes behind autocomplete (search_index.py, ranked_search) and master_table's full text search
+# (master_search, migration 2)
+
+ALBUMS = {
+    'ok': 'Radiohead - OK Computer',
+    'kida': 'Radiohead - Kid A',
+    'rad': 'Radical Face - Ghost',
+    'kids': 'MGMT - Oracular Spectacular',
+}
+
+
+def make_index():
+    index = SearchIndex()
+    for key, text in ALBUMS.items():
+        index.add(key, text)
+    return index
+
+
+def test_every_query_word_has_to_be_in_the_entry():
+    index = make_index()
+    assert set(index.search('rad')) == {'ok', 'kida', 'rad'}
+    assert set(index.search('rad ok')) == {'ok'}
+    assert set(index.search('head kid')) == {'kida'}
+    assert index.search('radiohead ghost') == []
+    assert len(index.search('', limit=2)) == 2
+
+
+def test_index_follows_adds_and_removes():
+    index = make_index()
+    # remembered lookups have to pick up words added and removed later
+    assert set(index.search('spec')) == {'kids'}
+    index.add('spec', 'Spectrum - Soul Kiss')
+    assert set(index.search('spec')) == {'kids', 'spec'}
+    index.remove('kids')
+    assert index.search('spec') == ['spec']
+    assert 'oracular' not in index.keys_by_word
+    # adding a key again replaces its text
+    index.add('spec', 'Someone Else - Something')
+    assert index.search('spec') == []
+    assert len(index) == 4
+
+
+def test_ranked_search_puts_better_matches_first_and_forgives_typos():
+    index = make_index()
+    assert ranked_search(index, 'radiohead kid')[0] == 'kida'
+    assert ranked_search(index, 'radical')[0] == 'rad'
+    assert 'ok' in ranked_search(index, 'radiohaed computr')
+
+
+def test_master_table_search(open_tables, make_album):
+    async def run():
+        t = open_tables()
+        await t.master_table.add_rows([make_album('ok', 'OK Computer', 'Radiohead'),
+                                       make_album('kida', 'Kid A', 'Radiohead'),
+                                       make_album('rad', 'Ghost', 'Radical Face'),
+                                       make_album('sigur', 'Ágætis byrjun', 'Sigur Rós')])
+        assert {row['album_id'] for row in await t.master_table.search('rad')} == {'ok', 'kida', 'rad'}
+        assert [row['album_id'] for row in await t.master_table.search('radio comp')] == ['ok']
+        # accents don't matter, and punctuation in the query can't break the fts syntax
+        assert [row['album_id'] for row in await t.master_table.search('sigur ros')] == ['sigur']
+        assert [row['album_id'] for row in await t.master_table.search('rós')] == ['sigur']
+        assert await t.master_table.search('" OR *') == []
+        # the in-memory index is kept in step with the table
+        assert set(t.master_table.album_index.search('radiohead')) == {'ok', 'kida'}
+        await t.master_table.remove_row('ok')
+        assert set(t.master_table.album_index.search('radiohead')) == {'kida'}
+        assert await t.master_table.search('computer') == []
+    asyncio.run(run())
+
+
+# artists saved before migration 4 have their non-ascii letters escaped, migration 4 rewrites and reindexes them
+def test_migration_unescapes_artists(open_tables):
+    async def run():
+        t = open_tables()
+        await t.master_table(r'''INSERT INTO master_table (album_id, album_name, artist, year, album_cover_url)
+        VALUES ('sigur', 'Takk...', '["Sigur R\u00f3s", "J\u00f3nsi"]', 2005, '')''')
+        assert await t.master_table.search('ros') == []
+        t.db.execute_blocking('PRAGMA user_version = 3')
+        t.db.run_blocking(migrations.migrate)
+        [row] = await t.master_table.search('ros')
+        assert row['artist'] == ('Sigur Rós', 'Jónsi')
+        assert [row['album_id'] for row in await t.master_table.search('jonsi takk')] == ['sigur']
+    asyncio.run(run())
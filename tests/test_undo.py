@@ -0,0 +1,69 @@
+import asyncio
+import pytest
+from undo import Undoer
+
+
+# stands in for Spotify.get_albums, undo only needs the albums to put them back in master_table
+class FakeSpotify:
+    def __init__(self, make_album):
+        self.make_album = make_album
+
+    async def get_albums(self, album_ids):
+        return [self.make_album(album_id) for album_id in album_ids]
+
+
+def make_undoer(t, make_album):
+    return Undoer(FakeSpotify(make_album), t.master_table, t.rating_table, t.homework_table, t.event_log_table)
+
+
+def test_undo_reverses_a_whole_transaction(open_tables, make_album):
+    async def run():
+        t = open_tables()
+        undoer = make_undoer(t, make_album)
+        await t.master_table.add_row(make_album('a'))
+        await t.homework_table.add_homework(1, 'a')
+        # what /add-rating does: rate the album and take it off the homework list, together
+        async with t.db.transaction():
+            await t.rating_table.add_row('a', 1, 8.0)
+            await t.homework_table.remove_homework(1, 'a')
+        # someone else's change in between shouldn't get caught up in it
+        await t.rating_table.add_row('a', 2, 4.0)
+
+        events, albums = await undoer.undo_last_event(1)
+        assert [event['action'] for event in events] == ['homework_remove', 'rating_add']
+        assert set(albums) == {'a'}
+        assert await t.rating_table.get_single_rating(1, 'a') == []
+        assert [row['album_id'] for row in await t.homework_table.get_homework(1)] == ['a']
+        assert len(await t.rating_table.get_single_rating(2, 'a')) == 1
+
+        # undoing again goes back to the change before, instead of redoing
+        events, albums = await undoer.undo_last_event(1)
+        assert [event['action'] for event in events] == ['homework_add']
+        assert await t.homework_table.get_homework(1) == []
+        with pytest.raises(LookupError):
+            await undoer.undo_last_event(1)
+
+        history = await t.event_log_table.get_events(1)
+        assert [event['undone'] for event in history if event['undo_of'] is None] == [1, 1, 1]
+        assert sum(event['undo_of'] is not None for event in history) == 3
+    asyncio.run(run())
+
+
+def test_undo_rolls_back_when_part_of_it_cant_be_undone(open_tables, make_album):
+    async def run():
+        t = open_tables()
+        undoer = make_undoer(t, make_album)
+        await t.master_table.add_rows([make_album('a'), make_album('b')])
+        async with t.db.transaction():
+            await t.rating_table.add_row('a', 1, 8.0)
+            await t.rating_table.add_row('b', 1, 6.0)
+        # 'b' gets removed behind the event log's back, so its rating_add can't be undone anymore
+        await t.rating_table('DELETE FROM rating_table WHERE album_id = ?', ('b',))
+        await t.rating_table('DELETE FROM event_log WHERE action = ?', ('rating_remove',))
+
+        with pytest.raises(LookupError):
+            await undoer.undo_last_event(1)
+        # the rating of 'a' is still there, nothing was half undone
+        assert len(await t.rating_table.get_single_rating(1, 'a')) == 1
+        assert not any(event['undone'] for event in await t.event_log_table.get_events(1))
+    asyncio.run(run())
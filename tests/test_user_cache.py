@@ -0,0 +1,70 @@
+import asyncio
+import tables
+
+# the per user caches behind the autocompletes (BaseTable.cached_for_user)
+
+
+def ratings(rows):
+    return {row['album_id']: row['rating'] for row in rows}
+
+
+def test_cached_ratings_follow_writes(open_tables, make_album):
+    async def run():
+        t = open_tables()
+        await t.master_table.add_rows([make_album('a'), make_album('b')])
+        await t.rating_table.add_row('a', 1, 5.0)
+        assert ratings(await t.rating_table.get_users_ratings(1)) == {'a': 5.0}
+
+        await t.rating_table.edit_row('a', 1, 7.0)
+        assert ratings(await t.rating_table.get_users_ratings(1)) == {'a': 7.0}
+        await t.rating_table.add_rows(1, {'b': 3.0})
+        assert ratings(await t.rating_table.get_users_ratings(1)) == {'a': 7.0, 'b': 3.0}
+        await t.rating_table.remove_row('a', 1)
+        assert ratings(await t.rating_table.get_users_ratings(1)) == {'b': 3.0}
+
+        await t.homework_table.add_homework(1, 'b')
+        assert [row['album_id'] for row in await t.homework_table.get_homework(1)] == ['b']
+        await t.homework_table.remove_homework(1, 'b')
+        assert await t.homework_table.get_homework(1) == []
+    asyncio.run(run())
+
+
+def test_rolled_back_writes_never_reach_the_cache(open_tables, make_album):
+    async def run():
+        t = open_tables()
+        await t.master_table.add_row(make_album('a'))
+        await t.rating_table.add_row('a', 1, 5.0)
+        try:
+            async with t.db.transaction():
+                await t.rating_table.edit_row('a', 1, 9.0)
+                assert ratings(await t.rating_table.get_users_ratings(1)) == {'a': 9.0}
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        assert ratings(await t.rating_table.get_users_ratings(1)) == {'a': 5.0}
+    asyncio.run(run())
+
+
+# the second generation bump has to wait for the commit, otherwise a read in between could cache the old rows
+# under the new generation. so every write has to invalidate from inside a transaction
+def test_invalidation_waits_for_the_commit(open_tables, make_album, monkeypatch):
+    in_transaction = []
+    invalidate_user = tables.BaseTable.invalidate_user
+
+    def record(self, user_id):
+        in_transaction.append(self.db.in_transaction)
+        invalidate_user(self, user_id)
+    monkeypatch.setattr(tables.BaseTable, 'invalidate_user', record)
+
+    async def run():
+        t = open_tables()
+        await t.master_table.add_row(make_album('a'))
+        await t.rating_table.add_row('a', 1, 5.0)
+        await t.rating_table.edit_row('a', 1, 6.0)
+        await t.rating_table.add_rows(1, {'a': 8.0}, overwrite=True)
+        await t.rating_table.remove_row('a', 1)
+        await t.homework_table.add_homework(1, 'a')
+        await t.homework_table.remove_homework(1, 'a')
+        await t.homework_table.remove_many(1, ['a'])
+    asyncio.run(run())
+    assert len(in_transaction) == 7 and all(in_transaction)
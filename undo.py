@@ -0,0 +1,63 @@
+import sqlite3
+from dataclasses import dataclass
+from spotify_integration import Spotify
+from tables import MasterTable, RatingTable, HomeworkTable, EventLogTable
+
+# /undo, going back through a user's event log (see EventLogTable).
+# undoing an event makes the opposite change and marks the event as undone, and the triggers log that change
+# as an undo of it, so undoing again keeps going back instead of redoing
+
+
+@dataclass
+class Undoer:
+    spotify: Spotify
+    master_table: MasterTable
+    rating_table: RatingTable
+    homework_table: HomeworkTable
+    event_log_table: EventLogTable
+
+    # makes the opposite change of a user's newest change (that hasn't been undone already) and logs it as an undo.
+    # everything else the user changed in the same transaction gets undone with it (e.g. /add-rating also taking the
+    # album off their homework), newest first, all in one transaction.
+    # returns the events that got undone and {album_id: album} for their albums
+    async def undo_last_event(self, user_id: int):
+        event = await self.event_log_table.get_last_undoable(user_id)
+        if event is None:
+            raise LookupError("error: there's nothing left to undo")
+        events = await self.event_log_table.get_transaction_events(event)
+        # the albums might not be in master_table anymore (and we need their years anyway), so grab them before writing
+        albums = {album.id: album
+                  for album in await self.spotify.get_albums(list({event['album_id'] for event in events}))}
+        async with self.rating_table.transaction():
+            for event in events:
+                await self.undo_event(event, albums.get(event['album_id']))
+        await self.master_table.prune_index(*albums)
+        return events, albums
+
+    async def undo_event(self, event, album):
+        user_id, album_id, action = event['user_id'], event['album_id'], event['action']
+        if action == 'rating_add':
+            changed = await self.rating_table.remove_row(album_id, user_id)
+        elif action == 'rating_edit':
+            changed = await self.rating_table.edit_row(album_id, user_id, event['old_value'])
+        elif action == 'rating_remove':
+            if album is not None:
+                await self.master_table.add_row(album)
+            try:
+                changed = await self.rating_table.add_row(album_id, user_id, event['old_value'])
+            except sqlite3.IntegrityError:
+                changed = []
+        elif action == 'homework_add':
+            self.homework_table.invalidate_user(user_id)
+            changed = await self.homework_table(f'''DELETE FROM {self.homework_table.name}
+            WHERE album_id = ? AND user_id = ? RETURNING *''', (album_id, user_id))
+        else:
+            if album is not None:
+                await self.master_table.add_row(album)
+            try:
+                changed = [await self.homework_table.add_homework(user_id, album_id)]
+            except ValueError:
+                changed = []
+        if not changed:
+            raise LookupError(f"error: #{event['event_id']} can't be undone, that entry has changed since")
+        await self.event_log_table.mark_undone(event)